@@ -9,10 +9,29 @@ BASE_SIZE = 1024
 IMAGE_SIZE = 640
 CROP_MODE = True
 MIN_CROPS= 2
-MAX_CROPS= 6 # max:9; If your GPU memory is small, it is recommended to set it to 6.
+MAX_CROPS= 6 # max:9; If your GPU memory is small, set ENCODER_MEMORY_BUDGET_GB rather than lowering it to 6.
 MAX_CONCURRENCY = 100 # If you have limited GPU memory, lower the concurrency count.
 NUM_WORKERS = 64 # image pre-process (resize/padding) workers 
+PREPROCESS_BACKEND = 'thread' # thread / process: pre-process workers as processes handing tensors back through shared memory, see python -m process.preprocess_pool
 PRINT_NUM_VIS_TOKENS = False
+UINT8_PIXELS = False # keep pixel_values/images_crop as uint8 through the multimodal pipeline (4x less memory/IPC), normalized inside the model
+TENSOR_TILING = False # resize each page once as a tensor and take the tiles as views instead of PIL crops; python -m process.tensor_tiling compares both
+SAM_ATTN_BACKEND = 'auto' # auto / flash / sdpa / math / chunked; env DEEPENCODER_SAM_ATTN_BACKEND overrides
+CLIP_ATTN_BACKEND = 'auto' # auto / flash / sdpa / math / chunked; env DEEPENCODER_CLIP_ATTN_BACKEND overrides
+SAM_ATTN_CHUNK_SIZE = 0 # >0: SAM global-attention blocks run in query chunks of this size instead of a dense HW x HW rel-pos mask
+FUSED_PROJECTOR = False # split the projector weight into its CLIP/SAM halves instead of concatenating the features; in bf16 the second half adds one rounding step, see python -m deepencoder.build_linear
+ENCODER_MEMORY_BUDGET_GB = 0 # >0: stream tiles through the encoder in micro-batches that fit this activation budget
+COMPILE_ENCODER = False # torch.compile the vision encoder once per tile bucket, other shapes run eagerly
+COMPILE_BUCKETS = (1, 2, 4, 6, 9) # tile batches are zero-padded up to the next bucket
+EMBEDDING_CACHE_GB = 0 # >0: keep the vision embeddings of seen images (LRU, this many GB) so repeated pages skip the encoder
+TILE_CACHE_GB = 0 # >0: keep the local features of seen tiles (LRU, this many GB) so repeated headers/logos/margins skip the encoder
+EMBEDDING_CACHE_DIR = '' # optional directory for embeddings evicted from the caches, read back on a later hit
+# both caches live on the GPU next to the KV cache, lower gpu_memory_utilization by about as much
+ENCODE_BATCH_SIZE = 8 # pages per encoder call in run_dpsk_ocr_encode.py
+ENCODER_INT8 = False # run_dpsk_ocr_encode.py on CPU: dynamic int8 SAM/CLIP linears, see python -m deepencoder.quantize for the drift report
+ENCODER_WORKERS = 0 # run_dpsk_ocr_pdf.py: >0 runs the vision encoder in this many separate processes, overlapped with decoding
+ENCODER_WORKER_DEVICES = ['cpu'] # spread round robin over the workers, e.g. ['cuda:1']; GPUs must be visible under CUDA_VISIBLE_DEVICES of the runner
+ENCODER_WORKER_GPU_SHARE = 0.1 # gpu_memory_utilization taken from the engine for each encoder worker placed on its GPU (cuda:0)
 SKIP_REPEAT = True
 MODEL_PATH = 'deepseek-ai/DeepSeek-OCR' # change to your model path
 
@@ -23,6 +42,7 @@ MODEL_PATH = 'deepseek-ai/DeepSeek-OCR' # change to your model path
 
 INPUT_PATH = '' 
 OUTPUT_PATH = ''
+IMAGE_EMBEDS_PATH = '' # run_dpsk_ocr_pdf.py: <name>.embeds written by run_dpsk_ocr_encode.py, skips the vision encoder
 
 PROMPT = '<image>\n<|grounding|>Convert the document to markdown.'
 # PROMPT = '<image>\nFree OCR.'
@@ -37,6 +57,18 @@ PROMPT = '<image>\n<|grounding|>Convert the document to markdown.'
 # .......
 
 
-from transformers import AutoTokenizer
+import functools
 
-TOKENIZER = AutoTokenizer.from_pretrained(MODEL_PATH, trust_remote_code=True)
+
+@functools.lru_cache(maxsize=None)
+def get_tokenizer():
+    # loaded on first use, so importing the constants above stays cheap (no transformers import)
+    from transformers import AutoTokenizer
+    return AutoTokenizer.from_pretrained(MODEL_PATH, trust_remote_code=True)
+
+
+def __getattr__(name):
+    # `from config import TOKENIZER` keeps working, it loads the tokenizer at that point
+    if name == 'TOKENIZER':
+        return get_tokenizer()
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
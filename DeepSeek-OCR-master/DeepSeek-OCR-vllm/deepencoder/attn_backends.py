@@ -0,0 +1,110 @@
+import os
+import warnings
+from typing import Callable, Dict, Optional
+
+import torch
+import torch.nn.functional as F
+
+try:
+    from flash_attn import flash_attn_func
+except ImportError:
+    flash_attn_func = None
+
+
+# Every backend takes q, k, v with shape (B, nHead, L, C) -- usually strided views into the
+# packed qkv projection -- plus the optional decomposed rel-pos terms of the SAM encoder:
+# rel_h (B, nHead, L, k_h, 1) and rel_w (B, nHead, L, 1, k_w). It returns (B, nHead, L, C),
+# which may itself be a transposed view; callers go through .transpose(1, 2).reshape(...).
+ATTN_BACKENDS: Dict[str, Callable] = {}
+
+DEFAULT_CHUNK_SIZE = 1024
+
+_warned = set()
+
+
+def register_attn_backend(name: str):
+    def decorator(fn):
+        ATTN_BACKENDS[name] = fn
+        return fn
+    return decorator
+
+
+def _dense_bias(rel_h, rel_w):
+    if rel_h is None:
+        return None
+    B, num_heads, q_len, k_h, _ = rel_h.shape
+    return (rel_h + rel_w).view(B, num_heads, q_len, k_h * rel_w.size(-1))
+
+
+@register_attn_backend("sdpa")
+def sdpa_attention(q, k, v, rel_h=None, rel_w=None, chunk_size=0):
+    return F.scaled_dot_product_attention(q, k, v, attn_mask=_dense_bias(rel_h, rel_w))
+
+
+@register_attn_backend("math")
+def math_attention(q, k, v, rel_h=None, rel_w=None, chunk_size=0):
+    # plain matmul/softmax, handy as a reference and for graph export
+    attn = torch.matmul(q, k.transpose(-2, -1)) * (q.size(-1) ** -0.5)
+    attn_bias = _dense_bias(rel_h, rel_w)
+    if attn_bias is not None:
+        attn = attn + attn_bias
+    return torch.matmul(attn.softmax(dim=-1), v)
+
+
+@register_attn_backend("chunked")
+def chunked_attention(q, k, v, rel_h=None, rel_w=None, chunk_size=0):
+    # Queries are processed chunk by chunk and the rel-pos terms are added per chunk, so only a
+    # (B, nHead, chunk_size, k_len) slice of the bias exists at once: peak memory grows
+    # linearly with chunk_size instead of quadratically with the token count.
+    chunk_size = chunk_size or DEFAULT_CHUNK_SIZE
+    B, num_heads, q_len, _ = q.shape
+    k_len = k.size(2)
+    x = q.new_empty((B, num_heads, q_len, v.size(-1)))
+    for start in range(0, q_len, chunk_size):
+        end = min(start + chunk_size, q_len)
+        attn_bias = None
+        if rel_h is not None:
+            attn_bias = (rel_h[:, :, start:end] + rel_w[:, :, start:end]).view(B, num_heads, end - start, k_len)
+        x[:, :, start:end] = F.scaled_dot_product_attention(q[:, :, start:end], k, v, attn_mask=attn_bias)
+    return x
+
+
+@register_attn_backend("flash")
+def flash_attention(q, k, v, rel_h=None, rel_w=None, chunk_size=0):
+    # flash_attn wants (B, L, nHead, C); for views of a packed (B, L, 3, nHead, C) projection the
+    # transposes below are free, and so is transposing the output back
+    return flash_attn_func(q.transpose(1, 2), k.transpose(1, 2), v.transpose(1, 2)).transpose(1, 2)
+
+
+def _flash_usable(q: torch.Tensor, has_bias: bool) -> bool:
+    return (flash_attn_func is not None and q.is_cuda and not has_bias
+            and q.dtype in (torch.float16, torch.bfloat16))
+
+
+def select_attn_backend(name: Optional[str], q: torch.Tensor, has_bias: bool) -> str:
+    if name is None or name == "auto":
+        return "flash" if _flash_usable(q, has_bias) else "sdpa"
+    if name == "flash" and not _flash_usable(q, has_bias):
+        # e.g. CPU-only box, fp32 inputs, no flash_attn installed, or a rel-pos bias
+        if "flash" not in _warned:
+            _warned.add("flash")
+            warnings.warn("flash attention is not usable here, falling back to sdpa")
+        return "sdpa"
+    return name
+
+
+def attention(q, k, v, rel_h=None, rel_w=None, backend: Optional[str] = "auto", chunk_size: int = 0):
+    name = select_attn_backend(backend, q, rel_h is not None)
+    return ATTN_BACKENDS[name](q, k, v, rel_h, rel_w, chunk_size)
+
+
+def get_attn_backend_name(encoder: str, default: Optional[str] = None) -> str:
+    """
+    Backend for one encoder ("sam" or "clip"): DEEPENCODER_<ENCODER>_ATTN_BACKEND if set,
+    otherwise `default`, otherwise "auto".
+    """
+    name = os.environ.get(f"DEEPENCODER_{encoder.upper()}_ATTN_BACKEND") or default or "auto"
+    if name != "auto" and name not in ATTN_BACKENDS:
+        raise ValueError(f"Unknown attention backend for {encoder}: {name}, "
+                         f"expected one of {['auto'] + sorted(ATTN_BACKENDS)}")
+    return name
@@ -6,7 +6,7 @@ from easydict import EasyDict as adict
 import torch
 from torch.nn import functional as F
 from torch import nn
-from flash_attn import flash_attn_qkvpacked_func, flash_attn_func
+from deepencoder.attn_backends import attention, get_attn_backend_name
 # from optimus import flash_attn_func
 # from megatron.core import tensor_parallel
 # from megatron.core import parallel_state as mpu
@@ -128,6 +128,25 @@ class CLIPVisionEmbeddings(nn.Module):
             "position_ids", torch.arange(self.num_positions).expand((1, -1))
         )
 
+        # resized position embeddings keyed by (tgt_size, dtype, device)
+        self._pos_embed_cache = {}
+
+    def clear_cache(self):
+        self._pos_embed_cache.clear()
+
+    def _get_abs_pos(self, tgt_size):
+        # position_ids is arange(num_positions), so the lookup is the whole embedding table
+        if torch.is_grad_enabled() and self.position_embedding.weight.requires_grad:
+            return get_abs_pos(self.position_embedding(self.position_ids), tgt_size)
+
+        weight = self.position_embedding.weight
+        key = (tgt_size, weight.dtype, weight.device)
+        pos_embed = self._pos_embed_cache.get(key)
+        if pos_embed is None:
+            pos_embed = get_abs_pos(weight.detach()[None], tgt_size)
+            self._pos_embed_cache[key] = pos_embed
+        return pos_embed
+
     def forward(self, pixel_values, patch_embeds):
         batch_size = pixel_values.shape[0]
         # patch_embeds = self.patch_embedding(
@@ -144,14 +163,14 @@ class CLIPVisionEmbeddings(nn.Module):
         # shape = [*, width, grid, grid]
         # patch_embeds = patch_embeds.flatten(2).transpose(1, 2)
 
-        patch_embeds = patch_embeds.flatten(2).transpose(1, 2)
+        patch_embeds = patch_embeds.permute(0, 2, 3, 1).flatten(1, 2)  # no copy for channels-last input
 
 
         class_embeds = self.class_embedding.expand(batch_size, 1, -1)
         embeddings = torch.cat([class_embeds, patch_embeds], dim=1)
 
         # x = torch.cat([cls_token, x], dim=1)
-        embeddings = embeddings + get_abs_pos(self.position_embedding(self.position_ids), embeddings.size(1))
+        embeddings = embeddings + self._get_abs_pos(embeddings.size(1))
         # embeddings = embeddings + self.position_embedding(self.position_ids)
         return embeddings
 
@@ -232,6 +251,7 @@ class NoTPAttention(torch.nn.Module):
         self.head_dim = cfg.hidden_size // cfg.num_attention_heads
         self.max_seq_len = cfg.seq_length
         self.use_flash_attention = cfg.use_flash_attn
+        self.attn_backend = cfg.get("attn_backend") or ("flash" if cfg.use_flash_attn else "auto")
 
         self.qkv_proj = torch.nn.Linear(cfg.hidden_size, cfg.hidden_size * 3, bias=True)
         self.out_proj = torch.nn.Linear(cfg.hidden_size, cfg.hidden_size, bias=True)
@@ -248,38 +268,10 @@ class NoTPAttention(torch.nn.Module):
         xqkv = self.qkv_proj(x)
         xqkv = xqkv.view(bsz, seqlen, 3, self.num_heads, self.head_dim)
 
-        if self.use_flash_attention:
-            output = flash_attn_qkvpacked_func(xqkv)
-            output = output.view(bsz, seqlen, -1)
-            # xq, xk, xv = torch.split(xqkv, 1, dim=2)
-            # xq = xq.squeeze(2)
-            # xk = xk.squeeze(2)
-            # xv = xv.squeeze(2)
-            # # xq, xk, xv = xqkv[:, :, 0, ...], xqkv[:, :, 1, ...], xqkv[:, :, 2, ...]
-
-            # # （B, num_head, S, head_size)
-            # xq = xq.permute(0, 2, 1, 3)
-            # xk = xk.permute(0, 2, 1, 3)
-            # xv = xv.permute(0, 2, 1, 3)
-            # # with torch.backends.cuda.sdp_kernel(enable_flash=True, enable_math=False, enable_mem_efficient=False):
-            # output = torch.nn.functional.scaled_dot_product_attention(xq, xk, xv, attn_mask=None)
-            # output = output.permute(0, 2, 1, 3).reshape(bsz, seqlen, -1)
-                # output = output.permute(0, 2, 1, 3).contiguous().view(bsz, seqlen, -1)
-        else:
-            # output = flash_attn_qkvpacked_func(xqkv)
-            xq, xk, xv = torch.split(xqkv, 1, dim=2)
-            xq = xq.squeeze(2)
-            xk = xk.squeeze(2)
-            xv = xv.squeeze(2)
-            # xq, xk, xv = xqkv[:, :, 0, ...], xqkv[:, :, 1, ...], xqkv[:, :, 2, ...]
-
-            # （B, num_head, S, head_size)
-            xq = xq.permute(0, 2, 1, 3)
-            xk = xk.permute(0, 2, 1, 3)
-            xv = xv.permute(0, 2, 1, 3)
-            # with torch.backends.cuda.sdp_kernel(enable_flash=True, enable_math=False, enable_mem_efficient=False):
-            output = torch.nn.functional.scaled_dot_product_attention(xq, xk, xv, attn_mask=None)
-            output = output.permute(0, 2, 1, 3).reshape(bsz, seqlen, -1)
+        # （B, num_head, S, head_size) views into the packed projection, no split/squeeze copies
+        xq, xk, xv = xqkv.permute(2, 0, 3, 1, 4).unbind(0)
+        output = attention(xq, xk, xv, backend=self.attn_backend)
+        output = output.transpose(1, 2).reshape(bsz, seqlen, -1)
         output = self.out_proj(output)
         return output
 
@@ -444,9 +436,11 @@ vit_model_cfg = adict(
     recompute_list = []
 )
 
-def build_clip_l():
+def build_clip_l(attn_backend=None):
+    cfg = adict(vit_model_cfg)
+    cfg.attn_backend = get_attn_backend_name("clip", attn_backend)
     return VitModel(
-        cfg=vit_model_cfg,
+        cfg=cfg,
         freeze_embed=False,
         freeze_pre_norm=False,
     )
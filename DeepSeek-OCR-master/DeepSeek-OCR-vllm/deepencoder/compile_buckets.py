@@ -0,0 +1,102 @@
+import time
+from collections import Counter
+from typing import Callable, Dict, Optional, Sequence, Tuple
+
+import torch
+
+
+class BucketedCompiledEncoder:
+    """
+    torch.compile wrapper for the SAM -> CLIP -> projector forward that only ever sees a
+    fixed set of shapes. A batch of views is padded with zero views up to the next bucket
+    size, run through the graph compiled for (view size, bucket), and the padded rows are
+    dropped again; every view is encoded independently, so padding never leaks into the
+    real outputs. Batches larger than the biggest bucket are split into full buckets.
+    View sizes outside `view_sizes` run eagerly.
+
+    The encoder memoizes resized position embeddings and rel-pos tables in per-module dicts
+    that dynamo guards on, so an entry added after compiling invalidates the graphs. Before
+    the first compiled call the wrapper fills them for every view size with one eager call
+    each (again after reset_warm_up, e.g. when the weights are reloaded).
+    """
+
+    def __init__(
+        self,
+        encode_fn: Callable[[torch.Tensor], torch.Tensor],
+        buckets: Sequence[int] = (1, 2, 4, 6, 9),
+        view_sizes: Sequence[int] = (640, 1024),
+        mode: Optional[str] = None,
+    ):
+        self.encode_fn = encode_fn
+        self.buckets = sorted(buckets)
+        self.view_sizes = set(view_sizes)
+        # cuda graphs reuse their output buffers between replays
+        self.clone_outputs = mode == "reduce-overhead"
+
+        # one static graph per (view size, bucket), twice that as headroom for recompiles
+        # (cache reset, another dtype) before dynamo falls back to eager
+        cache_size_limit = 2 * len(self.buckets) * len(self.view_sizes)
+        torch._dynamo.config.cache_size_limit = max(torch._dynamo.config.cache_size_limit, cache_size_limit)
+        self.compiled_fn = torch.compile(encode_fn, mode=mode, dynamic=False)
+        self.warmed_up = set()
+
+        # compile time includes recompiles, recompiles counts the compilations of a key after its first call
+        self.compile_time: Dict[Tuple[int, int], float] = Counter()
+        self.recompiles: Counter = Counter()
+        self.hits: Counter = Counter()
+        self.eager_calls = 0
+
+    def reset_warm_up(self) -> None:
+        # the encoder's caches were cleared, fill them again before the next compiled call
+        self.warmed_up.clear()
+
+    def _warm_up(self, images: torch.Tensor) -> None:
+        key = (images.dtype, images.device)
+        if key in self.warmed_up:
+            return
+        with torch.no_grad():
+            for size in sorted(self.view_sizes):
+                self.encode_fn(images.new_zeros((1, images.size(1), size, size)))
+        self.warmed_up.add(key)
+
+    def __call__(self, images: torch.Tensor) -> torch.Tensor:
+        height, width = images.shape[-2:]
+        if height != width or height not in self.view_sizes:
+            self.eager_calls += 1
+            return self.encode_fn(images)
+
+        self._warm_up(images)
+        max_bucket = self.buckets[-1]
+        outputs = [self._run_bucket(images[start:start + max_bucket]) for start in range(0, images.size(0), max_bucket)]
+        return outputs[0] if len(outputs) == 1 else torch.cat(outputs, dim=0)
+
+    def _run_bucket(self, images: torch.Tensor) -> torch.Tensor:
+        num_views = images.size(0)
+        bucket = next(b for b in self.buckets if b >= num_views)
+        if bucket > num_views:
+            images = torch.cat([images, images.new_zeros((bucket - num_views, *images.shape[1:]))], dim=0)
+
+        key = (images.size(-1), bucket)
+        frames = torch._dynamo.utils.counters["frames"]["ok"]
+        start = time.perf_counter()
+        output = self.compiled_fn(images)
+        if torch._dynamo.utils.counters["frames"]["ok"] > frames:
+            elapsed = time.perf_counter() - start
+            self.compile_time[key] += elapsed
+            if self.hits[key]:
+                self.recompiles[key] += 1
+                print(f'deepencoder: recompiled view size {key[0]} bucket {bucket} in {elapsed:.1f}s')
+            else:
+                print(f'deepencoder: compiled view size {key[0]} bucket {bucket} in {elapsed:.1f}s')
+        self.hits[key] += 1
+
+        output = output[:num_views]
+        return output.clone() if self.clone_outputs else output
+
+    def stats(self) -> Dict[str, object]:
+        return {
+            "compile_time": dict(self.compile_time),
+            "recompiles": dict(self.recompiles),
+            "bucket_hits": dict(self.hits),
+            "eager_calls": self.eager_calls,
+        }
@@ -0,0 +1,110 @@
+import os
+import platform
+from typing import Optional
+
+import torch
+from torch import nn
+
+
+def cpu_has_native_bf16() -> bool:
+    """
+    True if the CPU executes bf16 matmuls natively: AVX512-BF16 / AMX-BF16 on x86,
+    the BF16 extension on aarch64. Elsewhere bf16 is emulated and slower than fp32.
+    """
+    flags = set()
+    try:
+        with open("/proc/cpuinfo") as f:
+            for line in f:
+                if line.startswith(("flags", "Features")):
+                    flags.update(line.split(":", 1)[1].split())
+    except OSError:
+        pass
+    if platform.machine().lower() in ("arm64", "aarch64"):
+        return "bf16" in flags or platform.system() == "Darwin"
+    return bool(flags & {"avx512_bf16", "amx_bf16"})
+
+
+def cpu_autocast_dtype() -> torch.dtype:
+    return torch.bfloat16 if cpu_has_native_bf16() else torch.float32
+
+
+def tune_cpu_threads(num_threads: int = 0) -> int:
+    """
+    Intra-op threads for the encoder: one per physical core this process may run on unless
+    `num_threads` is given. Hyper-threads share the matmul units and only add contention.
+    """
+    if not num_threads:
+        logical = len(os.sched_getaffinity(0)) if hasattr(os, "sched_getaffinity") else os.cpu_count()
+        siblings = 1
+        try:
+            with open("/sys/devices/system/cpu/cpu0/topology/thread_siblings_list") as f:
+                siblings = len(f.read().replace("-", ",").split(","))
+        except OSError:
+            pass
+        num_threads = max(1, logical // siblings)
+    torch.set_num_threads(num_threads)
+    return num_threads
+
+
+def prepare_cpu_encoder(encoder: nn.Module) -> nn.Module:
+    """
+    fp32 weights (autocast picks the compute dtype), channels-last SAM convolutions, and
+    sdpa instead of flash attention, which has no CPU kernels.
+    """
+    encoder = encoder.to("cpu", torch.float32).eval()
+    sam_model = encoder.sam_model
+    for module in (sam_model.patch_embed, sam_model.neck, sam_model.net_2, sam_model.net_3):
+        module.to(memory_format=torch.channels_last)
+    for module in encoder.modules():
+        if getattr(module, "attn_backend", None) == "flash":
+            module.attn_backend = "sdpa"
+    return encoder
+
+
+def peak_cpu_bytes(fn):
+    """
+    (fn(), peak CPU memory allocated while it ran in bytes): running sum of the profiler's
+    per-op allocations / frees, in op start order.
+    """
+    with torch.profiler.profile(activities=[torch.profiler.ProfilerActivity.CPU], profile_memory=True) as prof:
+        output = fn()
+    live = peak = 0
+    for event in sorted(prof.events(), key=lambda event: event.time_range.start):
+        live += event.self_cpu_memory_usage
+        peak = max(peak, live)
+    return output, peak
+
+
+if __name__ == '__main__':
+    # tiles/sec of the full-size encoder (random weights) on this CPU for the five presets
+    import time
+
+    from deepencoder.vision_tower import DeepEncoder
+
+    # name: (base_size, image_size, crop_mode), see config.py
+    presets = {
+        "tiny": (512, 512, False),
+        "small": (640, 640, False),
+        "base": (1024, 1024, False),
+        "large": (1280, 1280, False),
+        "gundam": (1024, 640, True),
+    }
+    num_views = 4
+
+    encoder = DeepEncoder()
+    encoder.enable_cpu_mode()
+    print(f'threads: {torch.get_num_threads()}  autocast: {encoder.encoder_autocast_dtype or torch.float32}')
+
+    for name, (base_size, image_size, crop_mode) in presets.items():
+        # crop mode encodes image_size tiles (plus one base_size global view per page)
+        views = torch.randn(num_views, 3, image_size, image_size)
+        encoder._encode_views(views[:1])  # warm-up, e.g. position-embedding resize
+        start = time.perf_counter()
+        encoder._encode_views(views)
+        elapsed = time.perf_counter() - start
+        line = f'{name:7s} {image_size:5d}px  tiles/sec: {num_views / elapsed:6.2f}'
+        if crop_mode:
+            start = time.perf_counter()
+            encoder._encode_views(torch.randn(1, 3, base_size, base_size))
+            line += f'  + global {base_size}px view: {time.perf_counter() - start:.2f}s/page'
+        print(line)
@@ -0,0 +1,147 @@
+import glob
+import hashlib
+import os
+from collections import OrderedDict
+from typing import Dict, List, Optional, Sequence, Tuple
+
+import torch
+
+
+def hash_views(*views: torch.Tensor, mode=()) -> bytes:
+    """
+    16-byte blake2b digest of the encoder input of one image: its views' shapes and pixels,
+    plus `mode` (base/image size, crop layout). hashlib releases the GIL on large buffers,
+    so this runs in parallel inside the preprocessing thread pool.
+    """
+    hasher = hashlib.blake2b(repr(mode).encode(), digest_size=16)
+    for view in views:
+        view = view.detach().cpu().contiguous()
+        hasher.update(repr((tuple(view.shape), view.dtype)).encode())
+        hasher.update(view.view(torch.uint8).numpy() if view.numel() else b"")
+    return hasher.digest()
+
+
+class EmbeddingCache:
+    """
+    LRU cache of projected vision embeddings keyed by a content hash of the encoder input.
+
+    Entries are kept on the device they were produced on until `max_bytes` is exceeded;
+    the least recently used ones are then evicted, or written to `spill_dir` (if given)
+    and read back from disk on a later hit.
+
+    Keys only cover the encoder input, so spilled entries live under a `namespace`
+    subdirectory identifying the encoder that produced them (see set_namespace): a
+    persistent spill_dir never serves embeddings of another checkpoint or encoder mode.
+    """
+
+    def __init__(self, max_bytes: int, spill_dir: Optional[str] = None, namespace: Optional[str] = None):
+        self.max_bytes = max_bytes
+        self._entries: "OrderedDict[str, torch.Tensor]" = OrderedDict()
+        self.num_bytes = 0
+
+        self.spill_root = spill_dir or None
+        self.spill_dir = None
+        self.namespace = None
+        self.set_namespace(namespace)
+
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.spills = 0
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def set_namespace(self, namespace: Optional[str]) -> None:
+        """Switch to the entries of another encoder; the in-memory ones belong to the old one."""
+        self.clear(spilled=False)
+        self.namespace = namespace
+        if self.spill_root:
+            self.spill_dir = os.path.join(self.spill_root, namespace) if namespace else self.spill_root
+            os.makedirs(self.spill_dir, exist_ok=True)
+
+    def _spill_path(self, key: str) -> str:
+        return os.path.join(self.spill_dir, f"{key}.pt")
+
+    def get(self, key: str, device: Optional[torch.device] = None) -> Optional[torch.Tensor]:
+        embedding = self._entries.get(key)
+        if embedding is not None:
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return embedding
+
+        if self.spill_dir and os.path.exists(self._spill_path(key)):
+            embedding = torch.load(self._spill_path(key), map_location=device)
+            self.disk_hits += 1
+            self.put(key, embedding)
+            return embedding
+
+        self.misses += 1
+        return None
+
+    def lookup(
+        self, keys: Sequence[str], device: Optional[torch.device] = None
+    ) -> Tuple[Dict[str, torch.Tensor], List[int]]:
+        """
+        Looks up a batch of keys. Returns the cached entries and the index of the first
+        occurrence of every missing key; repeats of a missing key within the batch count
+        as hits, they are only encoded once.
+        """
+        found, misses, pending = {}, [], set()
+        for index, key in enumerate(keys):
+            if key in pending:
+                self.hits += 1
+                continue
+            embedding = self.get(key, device)
+            if embedding is None:
+                pending.add(key)
+                misses.append(index)
+            else:
+                found[key] = embedding
+        return found, misses
+
+    def put(self, key: str, embedding: torch.Tensor) -> None:
+        if key in self._entries:
+            self._entries.move_to_end(key)
+            return
+
+        # embeddings are usually views into a batch-wide buffer, keep only their own storage
+        embedding = embedding.detach().clone()
+        num_bytes = embedding.numel() * embedding.element_size()
+        if num_bytes > self.max_bytes:
+            return
+
+        self._entries[key] = embedding
+        self.num_bytes += num_bytes
+        while self.num_bytes > self.max_bytes:
+            old_key, old_embedding = self._entries.popitem(last=False)
+            self.num_bytes -= old_embedding.numel() * old_embedding.element_size()
+            self.evictions += 1
+            if self.spill_dir and not os.path.exists(self._spill_path(old_key)):
+                torch.save(old_embedding.cpu(), self._spill_path(old_key))
+                self.spills += 1
+
+    def clear(self, spilled: bool = True) -> None:
+        """Drop the in-memory entries and, unless `spilled` is False, the spilled ones of this namespace."""
+        self._entries.clear()
+        self.num_bytes = 0
+        if spilled and self.spill_dir:
+            for path in glob.glob(os.path.join(self.spill_dir, "*.pt")):
+                os.remove(path)
+
+    def reset_stats(self) -> None:
+        self.hits = self.disk_hits = self.misses = self.evictions = self.spills = 0
+
+    def stats(self) -> Dict[str, float]:
+        lookups = self.hits + self.disk_hits + self.misses
+        return {
+            "entries": len(self._entries),
+            "bytes": self.num_bytes,
+            "hits": self.hits,
+            "disk_hits": self.disk_hits,
+            "misses": self.misses,
+            "hit_rate": (self.hits + self.disk_hits) / lookups if lookups else 0.0,
+            "evictions": self.evictions,
+            "spills": self.spills,
+        }
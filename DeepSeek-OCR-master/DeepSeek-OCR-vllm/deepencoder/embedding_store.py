@@ -0,0 +1,62 @@
+import json
+import os
+from typing import Dict, List, Optional
+
+import numpy as np
+import torch
+
+# A store is a directory holding every page's projected embeddings back to back in one raw
+# bfloat16 file plus a json index of (offset, num_tokens) rows, so the decoder side can
+# memory-map it and only touch the pages it is about to prefill.
+EMBEDDINGS_FILE = "embeddings.bin"
+INDEX_FILE = "index.json"
+
+
+class EmbeddingStoreWriter:
+    """Appends per-page image embeddings [num_tokens, n_embed] to an embedding store."""
+
+    def __init__(self, path: str, n_embed: int = 1280):
+        os.makedirs(path, exist_ok=True)
+        self.path = path
+        self.n_embed = n_embed
+        self.pages: List[Dict[str, object]] = []
+        self.num_tokens = 0
+        self._file = open(os.path.join(path, EMBEDDINGS_FILE), "wb")
+
+    def write(self, embedding: torch.Tensor, **meta) -> None:
+        assert embedding.dim() == 2 and embedding.size(1) == self.n_embed, embedding.shape
+        # numpy has no bfloat16, the raw bits go through int16
+        embedding.detach().to(torch.bfloat16).cpu().view(torch.int16).numpy().tofile(self._file)
+        self.pages.append(dict(offset=self.num_tokens, num_tokens=embedding.size(0), **meta))
+        self.num_tokens += embedding.size(0)
+
+    def close(self) -> None:
+        self._file.close()
+        with open(os.path.join(self.path, INDEX_FILE), "w") as f:
+            json.dump({"dtype": "bfloat16", "n_embed": self.n_embed, "pages": self.pages}, f)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def load_embedding_store(path: str, pages: Optional[List[int]] = None) -> List[torch.Tensor]:
+    """
+    Memory-mapped [num_tokens, n_embed] bfloat16 embeddings of the stored pages (all of them
+    by default). Nothing is read from disk until a tensor is used.
+    """
+    with open(os.path.join(path, INDEX_FILE)) as f:
+        index = json.load(f)
+
+    num_tokens = sum(page["num_tokens"] for page in index["pages"])
+    # copy-on-write keeps the mapping lazy and gives torch a writable array
+    data = np.memmap(os.path.join(path, EMBEDDINGS_FILE), dtype=np.int16, mode="c",
+                     shape=(num_tokens, index["n_embed"]))
+
+    entries = index["pages"] if pages is None else [index["pages"][i] for i in pages]
+    return [
+        torch.from_numpy(data[page["offset"]:page["offset"] + page["num_tokens"]]).view(torch.bfloat16)
+        for page in entries
+    ]
@@ -0,0 +1,218 @@
+import itertools
+import queue
+import threading
+from concurrent.futures import Future
+from typing import Callable, List, Optional, Sequence
+
+import torch
+import torch.multiprocessing as mp
+
+from deepencoder.vision_tower import DeepEncoder, collate_image_features
+
+
+# Encoder disaggregation: the vision tower runs in its own processes (own device, own CUDA
+# context) and the decoding engine only gets embeddings back. Requests travel over a local
+# multiprocessing queue; torch moves the pixel tensors and the returned embeddings into
+# shared memory, so only handles are pickled.
+
+
+def load_pretrained_encoder(model_path: str, dtype: torch.dtype = torch.bfloat16, **kwargs) -> DeepEncoder:
+    encoder = DeepEncoder(**kwargs)
+    encoder.load_checkpoint(model_path)
+    return encoder.to(dtype)
+
+
+def random_encoder(seed: int = 0, dtype: torch.dtype = torch.float32, **kwargs) -> DeepEncoder:
+    # same seed -> same weights in every process, for tests without a checkpoint
+    torch.manual_seed(seed)
+    return DeepEncoder(**kwargs).to(dtype)
+
+
+def _worker_main(encoder_factory, device, num_threads, requests, results):
+    try:
+        encoder = encoder_factory()
+        if device == "cpu":
+            encoder.enable_cpu_mode(num_threads)
+        else:
+            if num_threads:
+                torch.set_num_threads(num_threads)
+            encoder = encoder.to(device).eval()
+        dtype = next(encoder.parameters()).dtype
+    except Exception as e:
+        # request id None: the worker is gone, the pool fails everything pending
+        results.put((None, None, None, f"{device}: {e!r}"))
+        return
+
+    while True:
+        request = requests.get()
+        if request is None:
+            break
+        request_id, pixel_values, images_crop, images_spatial_crop = request
+        try:
+            if pixel_values.is_floating_point():
+                pixel_values = pixel_values.to(dtype)
+            embeddings = encoder._pixel_values_to_embedding(
+                pixel_values.to(device), [crop.to(device) for crop in images_crop],
+                images_spatial_crop.to(device))
+            # one shared-memory segment per request instead of one per image
+            lengths = [embedding.size(0) for embedding in embeddings]
+            results.put((request_id, torch.cat(embeddings).cpu(), lengths, None))
+        except Exception as e:
+            results.put((request_id, None, None, repr(e)))
+
+
+class EncoderWorkerPool:
+    """
+    Pool of vision-encoder processes. `submit` returns a Future of the per-image embeddings
+    [num_image_tokens, n_embed] (CPU, shared memory), in the order the images were given.
+
+    Args:
+        encoder_factory: picklable callable building the DeepEncoder inside each worker,
+            e.g. functools.partial(load_pretrained_encoder, MODEL_PATH).
+        num_workers: number of encoder processes.
+        devices: devices the workers are spread over, round robin.
+        num_threads: torch intra-op threads per worker, 0 keeps the default (one per
+            physical core for CPU workers, which run in the encoder's CPU mode).
+    """
+
+    def __init__(
+        self,
+        encoder_factory: Callable[[], DeepEncoder],
+        num_workers: int = 1,
+        devices: Sequence[str] = ("cpu",),
+        num_threads: int = 0,
+    ):
+        ctx = mp.get_context("spawn")  # CUDA cannot be re-initialized in forked children
+        self._requests = ctx.Queue()
+        self._results = ctx.Queue()
+        self._workers = [
+            ctx.Process(target=_worker_main, daemon=True,
+                        args=(encoder_factory, devices[rank % len(devices)], num_threads,
+                              self._requests, self._results))
+            for rank in range(num_workers)
+        ]
+        for worker in self._workers:
+            worker.start()
+
+        self._ids = itertools.count()
+        self._futures = {}
+        self._error = None
+        self._lock = threading.Lock()
+        self._collector = threading.Thread(target=self._collect, daemon=True)
+        self._collector.start()
+
+    def submit(self, pixel_values: torch.Tensor, images_crop: List[torch.Tensor],
+               images_spatial_crop: torch.Tensor) -> Future:
+        # same layout as the model inputs, see collate_image_features
+        future = Future()
+        with self._lock:
+            if self._error is not None:
+                raise RuntimeError(f"encoder worker pool is broken: {self._error}")
+            request_id = next(self._ids)
+            self._futures[request_id] = future
+        self._requests.put((request_id, pixel_values, images_crop, images_spatial_crop))
+        return future
+
+    def submit_features(self, features: List[list]) -> Future:
+        """Encode tokenize_with_images outputs (one per image)."""
+        # pixels travel as float32 (or uint8 with UINT8_PIXELS), workers cast to their own dtype
+        return self.submit(*collate_image_features(features, dtype=torch.float32))
+
+    def _fail_pending(self, error: str):
+        with self._lock:
+            self._error = error
+            futures, self._futures = list(self._futures.values()), {}
+        for future in futures:
+            future.set_exception(RuntimeError(f"encoder worker failed: {error}"))
+
+    def _collect(self):
+        while True:
+            try:
+                result = self._results.get(timeout=1.0)
+            except queue.Empty:
+                # a crashed worker (segfault, OOM kill) posts nothing, its requests would hang
+                crashed = [worker for worker in self._workers if worker.exitcode not in (None, 0)]
+                if crashed:
+                    self._fail_pending(f"worker exited with code {crashed[0].exitcode}")
+                continue
+            if result is None:
+                break
+            request_id, flat, lengths, error = result
+            if request_id is None:
+                self._fail_pending(error)
+                continue
+            with self._lock:
+                future = self._futures.pop(request_id, None)
+            if future is None:
+                continue
+            if error is not None:
+                future.set_exception(RuntimeError(f"encoder worker failed: {error}"))
+            else:
+                future.set_result(list(flat.split(lengths)))
+
+    def close(self):
+        for _ in self._workers:
+            self._requests.put(None)
+        for worker in self._workers:
+            worker.join()
+            if worker.exitcode not in (None, 0):
+                self._fail_pending(f"worker exited with code {worker.exitcode}")
+        self._results.put(None)
+        self._collector.join()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+if __name__ == '__main__':
+    # CPU check with random weights and a stand-in decoder: pages are encoded in worker
+    # processes while the "decoder" consumes finished embeddings, compared with encoding
+    # and decoding inline one after the other.
+    import time
+    from functools import partial
+
+    num_pages, num_workers, decode_time = 8, 2, 1.0
+    torch.manual_seed(1)
+    # half the pages as a single 640 view, half with a 2x1 tile grid
+    pages = []
+    for idx in range(num_pages):
+        crop_shape = [2, 1] if idx % 2 else [1, 1]
+        num_crops = 2 if idx % 2 else 0
+        pages.append([None, torch.randn(1, 3, 640, 640), torch.randn(1, num_crops, 3, 640, 640),
+                      None, torch.tensor([crop_shape])])
+
+    def stand_in_decoder(embedding):
+        time.sleep(decode_time)  # prefill + decode of one page
+        return embedding.float().sum().item()
+
+    factory = partial(random_encoder, seed=0)
+
+    encoder = factory()
+    encoder.enable_cpu_mode()  # all physical cores for the inline run
+    threads = max(1, torch.get_num_threads() // num_workers)
+    start = time.perf_counter()
+    reference = []
+    for page in pages:
+        embedding = encoder._pixel_values_to_embedding(*collate_image_features([page], dtype=torch.float32))[0]
+        stand_in_decoder(embedding)
+        reference.append(embedding)
+    inline_time = time.perf_counter() - start
+
+    with EncoderWorkerPool(factory, num_workers=num_workers, num_threads=threads) as pool:
+        # wait for the workers to build their encoders before timing
+        pool.submit_features(pages[:1]).result()
+        start = time.perf_counter()
+        futures = [pool.submit_features([page]) for page in pages]
+        outputs = []
+        for future in futures:
+            embedding = future.result()[0]
+            stand_in_decoder(embedding)
+            outputs.append(embedding)
+        pool_time = time.perf_counter() - start
+
+    max_diff = max((a - b).abs().max().item() for a, b in zip(reference, outputs))
+    print(f'pages: {num_pages}  inline: {inline_time:.1f}s  {num_workers} workers: {pool_time:.1f}s  '
+          f'max abs diff: {max_diff:.2e}')
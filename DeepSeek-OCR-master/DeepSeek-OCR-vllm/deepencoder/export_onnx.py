@@ -0,0 +1,113 @@
+import argparse
+import os
+from typing import Dict, Optional, Sequence
+
+import numpy as np
+import torch
+from torch import nn
+
+from deepencoder.vision_tower import DeepEncoder
+
+
+# One graph per view size: SAM -> CLIP -> projector for a [num_views, 3, size, size] batch,
+# returning the projected [num_views, (size // 64) ** 2, n_embed] features. The token layout
+# (image_newline per row, view_seperator) is plain indexing and stays on the runtime side,
+# see DeepEncoderMixin._assemble_image_embeddings; both vectors are saved next to the graphs.
+
+
+class EncoderGraph(nn.Module):
+    def __init__(self, encoder: DeepEncoder):
+        super().__init__()
+        self.encoder = encoder
+
+    def forward(self, images: torch.Tensor) -> torch.Tensor:
+        return self.encoder._run_encoder(images)
+
+
+def prepare_for_export(encoder: DeepEncoder, view_sizes: Sequence[int]) -> DeepEncoder:
+    """
+    fp32 on CPU with the plain matmul/softmax attention (decomposed rel-pos bias included),
+    and the resized position embeddings and gathered rel-pos tables of every view size
+    cached up front, so they are baked into the graph as constants instead of tracing the
+    antialiased bicubic resize.
+    """
+    encoder = encoder.to("cpu", torch.float32).eval()
+    for module in encoder.modules():
+        if hasattr(module, "attn_backend"):
+            module.attn_backend = "math"
+        if hasattr(module, "attn_chunk_size"):
+            module.attn_chunk_size = 0
+    with torch.no_grad():
+        for size in view_sizes:
+            encoder._run_encoder(torch.zeros(1, 3, size, size))
+    return encoder
+
+
+def export_encoder(encoder: DeepEncoder, output_dir: str, view_sizes: Sequence[int] = (640, 1024),
+                   opset: int = 17) -> Dict[int, str]:
+    os.makedirs(output_dir, exist_ok=True)
+    encoder = prepare_for_export(encoder, view_sizes)
+    graph = EncoderGraph(encoder).eval()
+
+    paths = {}
+    for size in view_sizes:
+        path = os.path.join(output_dir, f"deepencoder_{size}.onnx")
+        with torch.no_grad():
+            torch.onnx.export(
+                graph, (torch.randn(2, 3, size, size),), path,
+                input_names=["images"], output_names=["features"],
+                dynamic_axes={"images": {0: "num_views"}, "features": {0: "num_views"}},
+                opset_version=opset,
+            )
+        paths[size] = path
+        print(f'exported {path}')
+
+    np.save(os.path.join(output_dir, "image_newline.npy"), encoder.image_newline.detach().numpy())
+    np.save(os.path.join(output_dir, "view_seperator.npy"), encoder.view_seperator.detach().numpy())
+    return paths
+
+
+def verify_export(encoder: DeepEncoder, paths: Dict[int, str], batch_sizes: Sequence[int] = (1, 3)) -> Optional[bool]:
+    """Compare onnxruntime (CPU) against the PyTorch modules, including batch sizes not seen at export."""
+    try:
+        import onnxruntime as ort
+    except ImportError:
+        print('onnxruntime is not installed, skipping verification')
+        return None
+
+    encoder = prepare_for_export(encoder, list(paths))
+    ok = True
+    for size, path in paths.items():
+        session = ort.InferenceSession(path, providers=["CPUExecutionProvider"])
+        for batch_size in batch_sizes:
+            images = torch.randn(batch_size, 3, size, size)
+            with torch.no_grad():
+                expected = encoder._run_encoder(images)
+            actual = torch.from_numpy(session.run(["features"], {"images": images.numpy()})[0])
+
+            max_diff = (actual - expected).abs().max().item()
+            cosine = torch.nn.functional.cosine_similarity(actual, expected, dim=-1).min().item()
+            passed = actual.shape == expected.shape and cosine > 0.9999
+            ok &= passed
+            print(f'{size}px x{batch_size}: shape {tuple(actual.shape)}  max abs diff {max_diff:.2e}  '
+                  f'min cosine {cosine:.6f}  {"ok" if passed else "MISMATCH"}')
+    return ok
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Export the DeepSeek-OCR vision encoder to ONNX")
+    parser.add_argument("--model-path", default=None, help="checkpoint directory or hub id, random weights if omitted")
+    parser.add_argument("--output-dir", default="deepencoder_onnx")
+    parser.add_argument("--sizes", type=int, nargs="+", default=[640, 1024])
+    parser.add_argument("--opset", type=int, default=17)
+    parser.add_argument("--no-verify", action="store_true")
+    args = parser.parse_args()
+
+    torch.manual_seed(0)
+    encoder = DeepEncoder()
+    if args.model_path:
+        encoder.load_checkpoint(args.model_path)
+
+    paths = export_encoder(encoder, args.output_dir, args.sizes, args.opset)
+    if not args.no_verify and verify_export(encoder, paths) is False:
+        raise SystemExit(1)
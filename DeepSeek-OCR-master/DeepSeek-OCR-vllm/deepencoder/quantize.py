@@ -0,0 +1,65 @@
+import io
+
+import torch
+from torch import nn
+
+
+def quantize_encoder_int8(encoder: nn.Module) -> nn.Module:
+    """
+    Dynamic int8 quantization of the SAM and CLIP towers, in place: every nn.Linear (qkv,
+    proj, the MLP blocks, NoTPFeedForward) keeps int8 weights and quantizes its activations
+    per batch. CPU only. The projector stays fp32, it is small and forward_split reads its
+    weight directly.
+    """
+    for tower in (encoder.sam_model, encoder.vision_model):
+        torch.ao.quantization.quantize_dynamic(tower, {nn.Linear}, dtype=torch.qint8, inplace=True)
+    return encoder
+
+
+def state_dict_bytes(module: nn.Module) -> int:
+    # packed int8 weights are not parameters, so count the serialized size instead
+    buffer = io.BytesIO()
+    torch.save(module.state_dict(), buffer)
+    return buffer.tell()
+
+
+if __name__ == '__main__':
+    # Drift / speed / memory report on synthetic pages: embedding cosine similarity of the
+    # int8 encoder (and bf16 autocast, where native) against fp32. Pass a model path to use
+    # the real checkpoint, random weights otherwise.
+    import copy
+    import sys
+    import time
+
+    import torchvision.transforms as T
+
+    from deepencoder.cpu import cpu_has_native_bf16
+    from deepencoder.vision_tower import DeepEncoder
+    from process.tiling import synthetic_page
+
+    transform = T.Compose([T.ToTensor(), T.Normalize((0.5, 0.5, 0.5), (0.5, 0.5, 0.5))])
+    pages = torch.stack([transform(synthetic_page(seed, 640, 640, figure=True)) for seed in range(8)])
+
+    torch.manual_seed(0)
+    reference = DeepEncoder()
+    if len(sys.argv) > 1:
+        reference.load_checkpoint(sys.argv[1])
+    reference.enable_cpu_mode(dtype=torch.float32)
+
+    variants = {"fp32": reference}
+    if cpu_has_native_bf16():
+        variants["bf16 autocast"] = copy.deepcopy(reference)
+        variants["bf16 autocast"].encoder_autocast_dtype = torch.bfloat16
+    variants["int8 dynamic"] = quantize_encoder_int8(copy.deepcopy(reference))
+
+    outputs = {}
+    for name, encoder in variants.items():
+        encoder._encode_views(pages[:1])  # warm-up
+        start = time.perf_counter()
+        outputs[name] = encoder._encode_views(pages).float()
+        elapsed = time.perf_counter() - start
+
+        cosine = torch.nn.functional.cosine_similarity(outputs[name], outputs["fp32"], dim=-1)
+        print(f'{name:14s} views/sec: {len(pages) / elapsed:6.2f}  '
+              f'weights: {state_dict_bytes(encoder) / 1024 ** 2:7.1f} MB  '
+              f'cosine vs fp32: mean {cosine.mean():.5f} min {cosine.min():.5f}')
@@ -10,7 +10,8 @@ import torch.nn.functional as F
 
 from typing import Optional, Tuple, Type
 from functools import partial
-from flash_attn import flash_attn_qkvpacked_func
+
+from deepencoder.attn_backends import attention, get_attn_backend_name
 # from .common import LayerNorm2d, MLPBlock
 
 # from mmgpt.model.vision_encoder.flash_4 import _attention_rel_h_rel_w
@@ -93,6 +94,8 @@ class ImageEncoderViT(nn.Module):
         rel_pos_zero_init: bool = True,
         window_size: int = 0,
         global_attn_indexes: Tuple[int, ...] = (),
+        attn_chunk_size: int = 0,
+        attn_backend: str = "auto",
     ) -> None:
         """
         Args:
@@ -111,9 +114,13 @@ class ImageEncoderViT(nn.Module):
             rel_pos_zero_init (bool): If True, zero initialize relative positional parameters.
             window_size (int): Window size for window attention blocks.
             global_attn_indexes (list): Indexes for blocks using global attention.
+            attn_chunk_size (int): If > 0, global attention blocks process queries in chunks of
+                this size instead of building the dense rel-pos mask.
+            attn_backend (str): Attention backend, see deepencoder.attn_backends.
         """
         super().__init__()
         self.img_size = img_size
+        self.attn_chunk_size = attn_chunk_size
 
         self.patch_embed = PatchEmbed(
             kernel_size=(patch_size, patch_size),
@@ -142,6 +149,8 @@ class ImageEncoderViT(nn.Module):
                 rel_pos_zero_init=rel_pos_zero_init,
                 window_size=window_size if i not in global_attn_indexes else 0,
                 input_size=(img_size // patch_size, img_size // patch_size),
+                attn_chunk_size=attn_chunk_size if i in global_attn_indexes else 0,
+                attn_backend=attn_backend,
             )
             self.blocks.append(block)
 
@@ -166,11 +175,28 @@ class ImageEncoderViT(nn.Module):
         self.net_2 = nn.Conv2d(256, 512, kernel_size=3, stride=2, padding=1, bias=False)
         self.net_3 = nn.Conv2d(512, 1024, kernel_size=3, stride=2, padding=1, bias=False)
 
+        # resized pos_embed keyed by (tgt_size, dtype, device)
+        self._pos_embed_cache = {}
+
+    def clear_cache(self) -> None:
+        self._pos_embed_cache.clear()
+
+    def _get_abs_pos(self, tgt_size: int) -> torch.Tensor:
+        if torch.is_grad_enabled() and self.pos_embed.requires_grad:
+            return get_abs_pos(self.pos_embed, tgt_size)
+
+        key = (tgt_size, self.pos_embed.dtype, self.pos_embed.device)
+        pos_embed = self._pos_embed_cache.get(key)
+        if pos_embed is None:
+            pos_embed = get_abs_pos(self.pos_embed.detach(), tgt_size)
+            self._pos_embed_cache[key] = pos_embed
+        return pos_embed
+
     def forward(self, x: torch.Tensor) -> torch.Tensor:
         x = self.patch_embed(x)
         if self.pos_embed is not None:
             # x = x + self.pos_embed
-            x = x + get_abs_pos(self.pos_embed, x.size(1))
+            x = x + self._get_abs_pos(x.size(1))
 
         for blk in self.blocks:
             x = blk(x)
@@ -198,6 +224,8 @@ class Block(nn.Module):
         rel_pos_zero_init: bool = True,
         window_size: int = 0,
         input_size: Optional[Tuple[int, int]] = None,
+        attn_chunk_size: int = 0,
+        attn_backend: str = "auto",
     ) -> None:
         """
         Args:
@@ -213,6 +241,8 @@ class Block(nn.Module):
                 use global attention.
             input_size (tuple(int, int) or None): Input resolution for calculating the relative
                 positional parameter size.
+            attn_chunk_size (int): Query chunk size of the rel-pos attention, 0 for the dense mask.
+            attn_backend (str): Attention backend, see deepencoder.attn_backends.
         """
         super().__init__()
         self.norm1 = norm_layer(dim)
@@ -223,6 +253,8 @@ class Block(nn.Module):
             use_rel_pos=use_rel_pos,
             rel_pos_zero_init=rel_pos_zero_init,
             input_size=input_size if window_size == 0 else (window_size, window_size),
+            attn_chunk_size=attn_chunk_size,
+            attn_backend=attn_backend,
         )
 
         self.norm2 = norm_layer(dim)
@@ -260,6 +292,8 @@ class Attention(nn.Module):
         use_rel_pos: bool = False,
         rel_pos_zero_init: bool = True,
         input_size: Optional[Tuple[int, int]] = None,
+        attn_chunk_size: int = 0,
+        attn_backend: str = "auto",
     ) -> None:
         """
         Args:
@@ -270,9 +304,15 @@ class Attention(nn.Module):
             rel_pos_zero_init (bool): If True, zero initialize relative positional parameters.
             input_size (tuple(int, int) or None): Input resolution for calculating the relative
                 positional parameter size.
+            attn_chunk_size (int): If > 0, add the decomposed rel-pos terms per query chunk of this
+                size instead of materialising the dense (B, nHead, H * W, H * W) mask.
+                Selects the "chunked" backend.
+            attn_backend (str): Attention backend, see deepencoder.attn_backends.
         """
         super().__init__()
         self.num_heads = num_heads
+        self.attn_chunk_size = attn_chunk_size
+        self.attn_backend = "chunked" if attn_chunk_size > 0 else attn_backend
         head_dim = dim // num_heads
         self.scale = head_dim**-0.5
 
@@ -288,35 +328,45 @@ class Attention(nn.Module):
             self.rel_pos_h = nn.Parameter(torch.zeros(2 * input_size[0] - 1, head_dim))
             self.rel_pos_w = nn.Parameter(torch.zeros(2 * input_size[1] - 1, head_dim))
 
+        # gathered (Rh, Rw) tables keyed by (q_size, k_size, dtype, device)
+        self._rel_pos_cache = {}
+
+    def clear_cache(self) -> None:
+        self._rel_pos_cache.clear()
+
+    def _get_rel_pos(
+        self, q_size: Tuple[int, int], k_size: Tuple[int, int]
+    ) -> Tuple[torch.Tensor, torch.Tensor]:
+        if torch.is_grad_enabled() and self.rel_pos_h.requires_grad:
+            return (
+                get_rel_pos(q_size[0], k_size[0], self.rel_pos_h),
+                get_rel_pos(q_size[1], k_size[1], self.rel_pos_w),
+            )
+
+        key = (q_size, k_size, self.rel_pos_h.dtype, self.rel_pos_h.device)
+        rel_pos = self._rel_pos_cache.get(key)
+        if rel_pos is None:
+            rel_pos = (
+                get_rel_pos(q_size[0], k_size[0], self.rel_pos_h.detach()),
+                get_rel_pos(q_size[1], k_size[1], self.rel_pos_w.detach()),
+            )
+            self._rel_pos_cache[key] = rel_pos
+        return rel_pos
+
     def forward(self, x: torch.Tensor) -> torch.Tensor:
         B, H, W, _ = x.shape
-        # qkv with shape (3, B, nHead, H * W, C)
-        qkv = self.qkv(x).reshape(B, H * W, 3, self.num_heads, -1).permute(2, 0, 3, 1, 4)
-        # q, k, v with shape (B * nHead, H * W, C)
-        q, k, v = qkv.reshape(3, B * self.num_heads, H * W, -1).unbind(0)
+        # q, k, v with shape (B, nHead, H * W, C), views into the packed qkv projection
+        q, k, v = self.qkv(x).view(B, H * W, 3, self.num_heads, -1).permute(2, 0, 3, 1, 4).unbind(0)
 
         rel_h, rel_w = None, None
         if self.use_rel_pos:
-            rel_h, rel_w = add_decomposed_rel_pos(q, self.rel_pos_h, self.rel_pos_w, (H, W), (H, W))
-
-        q = q.view(B, self.num_heads, H * W, -1)
-        k = k.view(B, self.num_heads, H * W, -1)
-        v = v.view(B, self.num_heads, H * W, -1)
-
-        if self.use_rel_pos:
-            rel_h = rel_h.view(B, self.num_heads, rel_h.size(1), rel_h.size(2), rel_h.size(3))
-            rel_w = rel_w.view(B, self.num_heads, rel_w.size(1), rel_w.size(2), rel_w.size(3))
-            attn_bias = (rel_h + rel_w).view(B, self.num_heads, rel_h.size(2), rel_h.size(3) * rel_w.size(4))
-            x = torch.nn.functional.scaled_dot_product_attention(q, k, v, attn_mask=attn_bias)
-            # x = _attention_rel_h_rel_w(q, k, v, rel_h, rel_w)
-        else:
-            x = torch.nn.functional.scaled_dot_product_attention(q, k, v)
-            # qkv = torch.stack([q, k, v], dim=1).transpose(1, 3).reshape(B, H * W, 3, self.num_heads, -1)
-            # x = flash_attn_qkvpacked_func(qkv, dropout_p=0.0, causal=False).transpose(1, 2)
+            # rel_h: (B, nHead, H * W, H, 1), rel_w: (B, nHead, H * W, 1, W)
+            Rh, Rw = self._get_rel_pos((H, W), (H, W))
+            rel_h, rel_w = decomposed_rel_pos(q, Rh, Rw, (H, W), (H, W))
 
-        
+        x = attention(q, k, v, rel_h, rel_w, backend=self.attn_backend, chunk_size=self.attn_chunk_size)
 
-        x = x.view(B, self.num_heads, H, W, -1).permute(0, 2, 3, 1, 4).reshape(B, H, W, -1)
+        x = x.transpose(1, 2).reshape(B, H, W, -1)
 
         x = self.proj(x)
 
@@ -427,19 +477,43 @@ def add_decomposed_rel_pos(
     Returns:
         attn (Tensor): attention map with added relative positional embeddings.
     """
+    Rh = get_rel_pos(q_size[0], k_size[0], rel_pos_h)
+    Rw = get_rel_pos(q_size[1], k_size[1], rel_pos_w)
+    return decomposed_rel_pos(q, Rh, Rw, q_size, k_size)
+
+
+def decomposed_rel_pos(
+    q: torch.Tensor,
+    Rh: torch.Tensor,
+    Rw: torch.Tensor,
+    q_size: Tuple[int, int],
+    k_size: Tuple[int, int],
+) -> Tuple[torch.Tensor, torch.Tensor]:
+    """
+    add_decomposed_rel_pos with the relative position tables already gathered by get_rel_pos.
+    Args:
+        q (Tensor): query q in the attention layer with shape (..., q_h * q_w, C), e.g.
+            (B, q_h * q_w, C) or a strided (B, nHead, q_h * q_w, C) view.
+        Rh (Tensor): gathered height-axis embeddings (q_h, k_h, C).
+        Rw (Tensor): gathered width-axis embeddings (q_w, k_w, C).
+        q_size (Tuple): spatial sequence size of query q with (q_h, q_w).
+        k_size (Tuple): spatial sequence size of key k with (k_h, k_w).
+
+    Returns:
+        rel_h (Tensor): height terms with shape (..., q_h * q_w, k_h, 1).
+        rel_w (Tensor): width terms with shape (..., q_h * q_w, 1, k_w).
+    """
     q_h, q_w = q_size
     k_h, k_w = k_size
-    Rh = get_rel_pos(q_h, k_h, rel_pos_h)
-    Rw = get_rel_pos(q_w, k_w, rel_pos_w)
 
-    B, _, dim = q.shape
-    r_q = q.reshape(B, q_h, q_w, dim)
-    rel_h = torch.einsum("bhwc,hkc->bhwk", r_q, Rh)
-    rel_w = torch.einsum("bhwc,wkc->bhwk", r_q, Rw)
+    *batch, _, dim = q.shape
+    r_q = q.reshape(*batch, q_h, q_w, dim)
+    rel_h = torch.einsum("...hwc,hkc->...hwk", r_q, Rh)
+    rel_w = torch.einsum("...hwc,wkc->...hwk", r_q, Rw)
     rel_h = rel_h.unsqueeze(-1)
     rel_w = rel_w.unsqueeze(-2)
-    rel_h = rel_h.reshape(B, q_h * q_w, k_h, 1)
-    rel_w = rel_w.reshape(B, q_h * q_w, 1, k_w)
+    rel_h = rel_h.reshape(*batch, q_h * q_w, k_h, 1)
+    rel_w = rel_w.reshape(*batch, q_h * q_w, 1, k_w)
 
     return rel_h, rel_w
 
@@ -478,13 +552,15 @@ class PatchEmbed(nn.Module):
         return x
 
 
-def build_sam_vit_b(checkpoint=None):
+def build_sam_vit_b(checkpoint=None, attn_chunk_size=0, attn_backend=None):
     return _build_sam(
         encoder_embed_dim=768,
         encoder_depth=12,
         encoder_num_heads=12,
         encoder_global_attn_indexes=[2, 5, 8, 11],
         checkpoint=checkpoint,
+        attn_chunk_size=attn_chunk_size,
+        attn_backend=get_attn_backend_name("sam", attn_backend),
     )
 
 
@@ -494,6 +570,8 @@ def _build_sam(
     encoder_num_heads,
     encoder_global_attn_indexes,
     checkpoint=None,
+    attn_chunk_size=0,
+    attn_backend="auto",
 ):
     prompt_embed_dim = 256
     image_size = 1024
@@ -512,6 +590,8 @@ def _build_sam(
             global_attn_indexes=encoder_global_attn_indexes,
             window_size=14,
             out_chans=prompt_embed_dim,
+            attn_chunk_size=attn_chunk_size,
+            attn_backend=attn_backend,
         )
     
     if checkpoint is not None:
@@ -525,4 +605,43 @@ def _build_sam(
         # tob
         image_encoder.load_state_dict({k[30:]: v for k, v in state_dict.items() if 'vision_tower_high' in k}, strict=True)
         print(checkpoint)
-    return image_encoder
\ No newline at end of file
+    return image_encoder
+
+
+if __name__ == '__main__':
+    # CPU check of the chunked rel-pos attention: a global ViT-B block on a 640px view
+    # (40x40 tokens) through "chunked" at several chunk sizes must match "sdpa" and "math";
+    # the peak memory of the attention grows with the chunk size, not with the token count.
+    from deepencoder.cpu import peak_cpu_bytes
+
+    torch.manual_seed(0)
+    grid = 40
+    block = Block(dim=768, num_heads=12, use_rel_pos=True, window_size=0, input_size=(grid, grid)).eval()
+    with torch.no_grad():
+        # zero-initialized rel-pos tables would leave the bias out of the comparison
+        block.attn.rel_pos_h.normal_(std=0.5)
+        block.attn.rel_pos_w.normal_(std=0.5)
+    x = torch.randn(1, grid, grid, 768)
+
+    def run(backend, chunk_size=0):
+        block.attn.attn_backend = backend
+        block.attn.attn_chunk_size = chunk_size
+        with torch.no_grad():
+            return peak_cpu_bytes(lambda: block(x))
+
+    reference, dense_peak = run("sdpa")
+    math_output, math_peak = run("math")
+    failed = not torch.allclose(math_output, reference, rtol=1e-4, atol=1e-5)
+    print(f'{grid * grid} tokens  sdpa peak: {dense_peak / 1024 ** 2:.1f} MB  math peak: {math_peak / 1024 ** 2:.1f} MB  '
+          f'math vs sdpa allclose: {not failed}')
+
+    for chunk_size in (100, 200, 400, 800, 1600):
+        output, peak = run("chunked", chunk_size)
+        matches = (torch.allclose(output, reference, rtol=1e-4, atol=1e-5)
+                   and torch.allclose(output, math_output, rtol=1e-4, atol=1e-5))
+        failed = failed or not matches
+        print(f'chunk size {chunk_size:5d}  peak: {peak / 1024 ** 2:7.1f} MB  '
+              f'max abs diff vs sdpa: {(output - reference).abs().max().item():.2e}  '
+              f'vs math: {(output - math_output).abs().max().item():.2e}  allclose: {matches}')
+    if failed:
+        raise SystemExit(1)
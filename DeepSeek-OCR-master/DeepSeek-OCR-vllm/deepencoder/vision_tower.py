@@ -0,0 +1,533 @@
+import glob
+import hashlib
+import math
+import os
+from typing import Iterable, Iterator, List, Optional, Set, Tuple
+
+import torch
+from addict import Dict
+from torch import nn
+
+from deepencoder.build_linear import MlpProjector
+from deepencoder.clip_sdpa import build_clip_l
+from deepencoder.compile_buckets import BucketedCompiledEncoder
+from deepencoder.cpu import cpu_autocast_dtype, prepare_cpu_encoder, tune_cpu_threads
+from deepencoder.embedding_cache import EmbeddingCache
+from deepencoder.quantize import quantize_encoder_int8
+from deepencoder.sam_vary_sdpa import build_sam_vit_b
+
+# checkpoint tensors of the vision tower, everything else belongs to the language model
+ENCODER_WEIGHT_NAMES = ('sam_model', 'vision_model', 'projector', 'image_newline', 'view_seperator')
+
+
+def is_encoder_weight(name: str) -> bool:
+    return any(key in name for key in ENCODER_WEIGHT_NAMES)
+
+
+def iter_encoder_weights(model_path: str) -> Iterator[Tuple[str, torch.Tensor]]:
+    """
+    (parameter name, tensor) of the vision tower from a checkpoint's safetensors shards (local
+    directory or hub id). Shards are memory-mapped and read one tensor at a time, the
+    language-model tensors are never touched.
+    """
+    from safetensors import safe_open
+
+    if not os.path.isdir(model_path):
+        from huggingface_hub import snapshot_download
+        model_path = snapshot_download(model_path, allow_patterns=["*.safetensors", "*.json"])
+
+    for filename in sorted(glob.glob(os.path.join(model_path, "*.safetensors"))):
+        with safe_open(filename, framework="pt", device="cpu") as f:
+            for name in f.keys():
+                if is_encoder_weight(name):
+                    yield name.replace('model.', '', 1), f.get_tensor(name)
+
+
+def get_image_token_layout(crop_shape: List[int], global_grid: int, local_grid: int) -> Tuple[int, int]:
+    """
+    Number of (local, global) embedding tokens of one image. Each grid row ends with an
+    image_newline token and the view separator adds one more token after both views.
+
+    Args:
+        crop_shape (list): [num_width_tiles, num_height_tiles] of the image.
+        global_grid (int): token grid side of the global view after the encoder.
+        local_grid (int): token grid side of one local tile after the encoder.
+    """
+    num_width_tiles, num_height_tiles = crop_shape
+    global_views_tokens = global_grid * (global_grid + 1)
+    if num_width_tiles > 1 or num_height_tiles > 1:
+        local_views_tokens = (num_height_tiles * local_grid) * (num_width_tiles * local_grid + 1)
+    else:
+        local_views_tokens = 0
+    return local_views_tokens, global_views_tokens
+
+
+def estimate_view_activation_bytes(
+    image_size: int,
+    dtype: torch.dtype = torch.bfloat16,
+    sam_attn_chunk_size: int = 0,
+    patch_size: int = 16,
+    sam_dim: int = 768,
+    sam_heads: int = 12,
+    sam_mlp_dim: int = 3072,
+    window_size: int = 14,
+    clip_dim: int = 1024,
+    clip_heads: int = 16,
+    clip_mlp_dim: int = 4096,
+) -> int:
+    """
+    Rough peak activation memory of encoding one image_size x image_size view: the residual
+    stream plus the largest transient of a SAM windowed block, a SAM global block (dense
+    rel-pos bias, or one query chunk of it) and a CLIP block on the SAM feature map. The
+    defaults are SAM ViT-B and CLIP-L, see DeepEncoderMixin._encoder_dims for the loaded
+    encoder. Weights are not included.
+    """
+    element_size = torch.empty((), dtype=dtype).element_size()
+
+    grid = image_size // patch_size
+    tokens = grid * grid
+    window_tokens = (math.ceil(grid / window_size) * window_size) ** 2
+    stream = tokens * sam_dim * 3  # residual, normed input, block output
+    window_attn = sam_heads * window_tokens * window_size * window_size * 2  # scores + rel-pos bias
+    global_attn = sam_heads * (sam_attn_chunk_size or tokens) * tokens * 2
+    sam_peak = stream + max(tokens * sam_dim * 3 + max(window_attn, global_attn), tokens * sam_mlp_dim)
+
+    # CLIP on the 4x downsampled SAM map plus the class token
+    clip_tokens = math.ceil(grid / 4) ** 2 + 1
+    clip_peak = clip_tokens * clip_dim * 3 + max(clip_tokens * clip_dim * 3 + clip_heads * clip_tokens ** 2,
+                                                 clip_tokens * clip_mlp_dim)
+
+    return element_size * (3 * image_size * image_size + max(sam_peak, clip_peak))
+
+
+def collate_image_features(features: List[list], device=None, dtype: torch.dtype = torch.bfloat16):
+    """
+    Stack single-image tokenize_with_images outputs into the batched layout the model sees:
+    pixel_values [n, 1, 3, H, W], images_crop (list of [1, P, 3, h, w]), images_spatial_crop [n, 1, 2].
+    """
+    # uint8 pixels (UINT8_PIXELS) stay uint8, the encoder normalizes them
+    pixel_values = torch.stack([item[1] for item in features])
+    pixel_values = pixel_values.to(device, dtype) if pixel_values.is_floating_point() else pixel_values.to(device)
+    images_crop = [item[2].to(device) for item in features]
+    images_spatial_crop = torch.stack([item[4] for item in features]).to(device)
+    return pixel_values, images_crop, images_spatial_crop
+
+
+class DeepEncoderMixin:
+    """Encoder-side forward of DeepSeek-OCR: SAM -> CLIP -> projector -> token layout.
+
+    Kept free of vLLM imports so the same code path can be benchmarked on its own.
+    The host module must provide ``sam_model``, ``vision_model``, ``projector``,
+    ``image_newline`` and ``view_seperator``.
+    """
+
+    # activation memory budget of one encoder call in bytes, 0 for no limit
+    encoder_memory_budget = 0
+
+    # compute dtype of encoder calls under autocast, None runs in the weight dtype
+    encoder_autocast_dtype: Optional[torch.dtype] = None
+
+    # projected embeddings keyed by image content, see enable_embedding_cache
+    embedding_cache: Optional[EmbeddingCache] = None
+    # projected local features keyed by tile content, see enable_tile_cache
+    tile_cache: Optional[EmbeddingCache] = None
+    # checksum of the loaded weights, part of the caches' namespace, see _encoder_fingerprint
+    _weights_digest: Optional[bytes] = None
+
+    def _clear_encoder_caches(self) -> None:
+        # cached tensors derived from weights (e.g. resized position embeddings) go stale on reload
+        for module in (self.sam_model, self.vision_model, self.projector):
+            for submodule in module.modules():
+                if hasattr(submodule, "clear_cache"):
+                    submodule.clear_cache()
+        if getattr(self, "_compiled_encoder", None) is not None:
+            self._compiled_encoder.reset_warm_up()
+        # spilled entries stay on disk under the old weights' namespace
+        self._weights_digest = None
+        for cache in (self.embedding_cache, self.tile_cache):
+            if cache is not None:
+                cache.clear(spilled=False)
+
+    def _encoder_fingerprint(self) -> str:
+        """
+        Identity of the encoder the cached embeddings come from: a checksum of the weights
+        (recomputed after loading or quantizing) plus dtype, device type, autocast, int8 and
+        compile mode.
+        """
+        if self._weights_digest is None:
+            with torch.no_grad():
+                sums = torch.stack([param.detach().float().sum() for param in self._encoder_params().values()])
+            self._weights_digest = sums.cpu().numpy().tobytes()
+        int8 = any(isinstance(module, torch.ao.nn.quantized.dynamic.Linear) for module in self.sam_model.modules())
+        mode = (str(self.image_newline.dtype), self.image_newline.device.type, str(self.encoder_autocast_dtype),
+                int8, getattr(self, "_compiled_encoder", None) is not None)
+        hasher = hashlib.blake2b(repr(mode).encode(), digest_size=8)
+        hasher.update(self._weights_digest)
+        return hasher.hexdigest()
+
+    def _sync_cache_namespaces(self) -> None:
+        fingerprint = self._encoder_fingerprint()
+        for cache in (self.embedding_cache, self.tile_cache):
+            if cache is not None and cache.namespace != fingerprint:
+                cache.set_namespace(fingerprint)
+
+    def _encoder_params(self) -> dict:
+        # parameters and buffers of the vision tower under their checkpoint names
+        params = {}
+        for prefix in ("sam_model", "vision_model", "projector"):
+            module = getattr(self, prefix)
+            params.update(module.named_parameters(prefix=prefix))
+            params.update(module.named_buffers(prefix=prefix))
+        params["image_newline"] = self.image_newline
+        params["view_seperator"] = self.view_seperator
+        return params
+
+    def _load_encoder_weights(self, weights: Iterable[Tuple[str, torch.Tensor]]) -> Set[str]:
+        """Copy vision-tower tensors straight into their parameters, one at a time."""
+        params = self._encoder_params()
+        loaded = set()
+        with torch.no_grad():
+            for name, tensor in weights:
+                params[name].copy_(tensor)
+                loaded.add(name)
+        self._clear_encoder_caches()
+        return loaded
+
+    def _normalize_pixels(self, views: torch.Tensor) -> torch.Tensor:
+        # uint8 views (UINT8_PIXELS) get ImageTransform's (x / 255 - 0.5) / 0.5 here, on the
+        # encoder device; normalized float views pass through
+        if views.dtype != torch.uint8:
+            return views
+        views = views.to(self.image_newline.device, non_blocking=True).float()
+        return views.div_(255).sub_(0.5).div_(0.5).to(self.image_newline.dtype)
+
+    def enable_embedding_cache(self, max_bytes: int, spill_dir: Optional[str] = None) -> None:
+        """Opt-in: reuse the embeddings of images seen before, e.g. one page under several prompts."""
+        self.embedding_cache = EmbeddingCache(max_bytes, spill_dir=spill_dir)
+
+    def enable_tile_cache(self, max_bytes: int, spill_dir: Optional[str] = None) -> None:
+        """Opt-in: reuse the local features of tiles seen before, e.g. headers, logos and blank margins."""
+        self.tile_cache = EmbeddingCache(max_bytes, spill_dir=spill_dir)
+
+    def enable_cpu_mode(self, num_threads: int = 0, dtype: Optional[torch.dtype] = None) -> None:
+        """
+        Opt-in CPU execution: fp32 weights, channels-last convolutions, autocast to bf16 where the
+        ISA has native bf16 (fp32 otherwise, or `dtype`), intra-op threads per physical core.
+        """
+        prepare_cpu_encoder(self)
+        tune_cpu_threads(num_threads)
+        dtype = dtype or cpu_autocast_dtype()
+        self.encoder_autocast_dtype = dtype if dtype != torch.float32 else None
+
+    def enable_int8_mode(self, num_threads: int = 0) -> None:
+        """Opt-in CPU execution with dynamic int8 Linear layers in SAM and CLIP, built from the loaded weights."""
+        self.enable_cpu_mode(num_threads, dtype=torch.float32)
+        quantize_encoder_int8(self)
+        self._weights_digest = None
+
+    def enable_compiled_encoder(self, buckets=(1, 2, 4, 6, 9), view_sizes=(640, 1024), mode=None) -> None:
+        """Opt-in: run the encoder through one static torch.compile graph per (view size, tile bucket)."""
+        self._compiled_encoder = BucketedCompiledEncoder(
+            self._run_encoder, buckets=buckets, view_sizes=view_sizes, mode=mode)
+
+    def _encode_views(self, images: torch.Tensor) -> torch.Tensor:
+        # Large tile batches are streamed through the encoder in micro-batches sized from
+        # encoder_memory_budget, writing into one preallocated output.
+        micro_batch = self._encoder_micro_batch_size(images)
+        if images.size(0) <= micro_batch:
+            return self._encode_micro_batch(images)
+
+        output = None
+        for start in range(0, images.size(0), micro_batch):
+            features = self._encode_micro_batch(images[start:start + micro_batch])
+            if output is None:
+                output = features.new_empty((images.size(0), *features.shape[1:]))
+            output[start:start + features.size(0)] = features
+            del features
+        return output
+
+    def _encoder_dims(self) -> dict:
+        # widths, heads and window of the loaded SAM and CLIP, the shape arguments of
+        # estimate_view_activation_bytes (norms and heads survive int8 quantization)
+        sam_blocks = self.sam_model.blocks
+        clip_block = self.vision_model.transformer.layers[0]
+        return dict(
+            patch_size=self.sam_model.patch_embed.proj.kernel_size[0],
+            sam_dim=sam_blocks[0].norm1.normalized_shape[0],
+            sam_heads=sam_blocks[0].attn.num_heads,
+            sam_mlp_dim=sam_blocks[0].mlp.lin1.out_features,
+            window_size=max((block.window_size for block in sam_blocks), default=0) or 14,
+            clip_dim=clip_block.dim,
+            clip_heads=clip_block.n_heads,
+            clip_mlp_dim=clip_block.mlp.fc1.out_features,
+        )
+
+    def _estimate_view_bytes(self, images: torch.Tensor) -> int:
+        return estimate_view_activation_bytes(
+            images.size(-1), images.dtype, sam_attn_chunk_size=getattr(self.sam_model, "attn_chunk_size", 0),
+            **self._encoder_dims())
+
+    def _encoder_micro_batch_size(self, images: torch.Tensor) -> int:
+        if not self.encoder_memory_budget:
+            return images.size(0)
+        return max(1, self.encoder_memory_budget // self._estimate_view_bytes(images))
+
+    def _encode_micro_batch(self, images: torch.Tensor) -> torch.Tensor:
+        encode_fn = getattr(self, "_compiled_encoder", None) or self._run_encoder
+        if self.encoder_autocast_dtype is None:
+            return encode_fn(images)
+        with torch.autocast(images.device.type, dtype=self.encoder_autocast_dtype):
+            return encode_fn(images)
+
+    def _run_encoder(self, images: torch.Tensor) -> torch.Tensor:
+        # images: [N, 3, H, W], all views in one call must share the same size
+        sam_features = self.sam_model(images)
+        clip_features = self.vision_model(images, sam_features)
+        # [N, C, h, w] -> [N, hw, C], a view for channels-last features
+        sam_tokens = sam_features.permute(0, 2, 3, 1).flatten(1, 2)
+        if self.projector.cfg.get("split_input", False):
+            # W_clip @ x_clip + W_sam @ x_sam + b, skips the (N, hw, 2048) concat
+            return self.projector.forward_split(clip_features[:, 1:], sam_tokens)
+        features = torch.cat((clip_features[:, 1:], sam_tokens), dim=-1)
+        return self.projector(features)
+
+    def _assemble_image_embeddings(
+        self,
+        global_features: torch.Tensor,
+        local_features: Optional[torch.Tensor],
+        crop_shapes: List[List[int]],
+    ) -> List[torch.Tensor]:
+        # Per image: [local grid rows + newline] [global grid rows + newline] [view separator].
+        # The layout is known up front, so one buffer is allocated for the whole batch and the
+        # projector outputs, newline columns and separators are written into strided slices of it.
+        _, hw, n_dim = global_features.shape
+        h = w = int(hw ** 0.5)
+        h2 = w2 = int(local_features.size(1) ** 0.5) if local_features is not None else 0
+
+        layouts = [get_image_token_layout(crop_shape, h, h2) for crop_shape in crop_shapes]
+        seq_lens = [num_local + num_global + 1 for num_local, num_global in layouts]
+        buffer = global_features.new_empty((sum(seq_lens), n_dim))
+        embeddings = buffer.split(seq_lens, dim=0)
+
+        tile_start = 0
+        for jdx, (embedding, (num_local, num_global)) in enumerate(zip(embeddings, layouts)):
+            if num_local > 0:
+                width_crop_num, height_crop_num = crop_shapes[jdx]
+                tile_end = tile_start + width_crop_num * height_crop_num
+                local_view = embedding[:num_local].view(height_crop_num * h2, width_crop_num * w2 + 1, n_dim)
+                local_view[:, :-1].view(height_crop_num, h2, width_crop_num, w2, n_dim).copy_(
+                    local_features[tile_start:tile_end].view(height_crop_num, width_crop_num, h2, w2, n_dim).permute(0, 2, 1, 3, 4)
+                )
+                local_view[:, -1] = self.image_newline
+                tile_start = tile_end
+
+            global_view = embedding[num_local:num_local + num_global].view(h, w + 1, n_dim)
+            global_view[:, :-1].copy_(global_features[jdx].view(h, w, n_dim))
+            global_view[:, -1] = self.image_newline
+            embedding[-1] = self.view_seperator
+
+        return list(embeddings)
+
+    def _pixel_values_to_embedding(
+        self,
+        pixel_values: torch.Tensor,
+        images_crop: torch.Tensor,
+        images_spatial_crop: torch.Tensor,
+        images_crop_hash: Optional[torch.Tensor] = None,
+    ) -> List[torch.Tensor]:
+
+        # Pixel_values (global view): [n_image, batch_size, 3, height, width]
+        # images_spatial_crop: [n_image, batch_size, [num_tiles_w, num_tiles_h]]
+        # images_crop (local view): [n_image, batch_size, num_pathes, 3, h, w]
+        # images_crop_hash (optional): [n_image, batch_size, num_pathes, 16], used by tile_cache
+        # all batch_size = 1
+        #
+        # Every global view of the step goes through the encoder in one call and every
+        # local tile in another, instead of two calls per image. The projected features
+        # are then scattered back into one embedding sequence per image.
+
+        crop_shapes = images_spatial_crop[:, 0].tolist()
+
+        with torch.no_grad():
+            if isinstance(pixel_values, torch.Tensor):
+                global_views = pixel_values.flatten(0, 1)
+            else:
+                global_views = torch.cat(list(pixel_values), dim=0)
+            global_views = self._normalize_pixels(global_views)
+
+            # the crop layout comes from metadata, pages without tiles carry an empty images_crop
+            crops = [
+                self._normalize_pixels(images_crop[jdx][0]).to(global_views.dtype)  # batch_size = 1
+                for jdx, (width_crop_num, height_crop_num) in enumerate(crop_shapes)
+                if width_crop_num > 1 or height_crop_num > 1
+            ]
+
+            global_features = self._encode_views(global_views)
+
+            local_features = None
+            if crops:
+                local_views = crops[0] if len(crops) == 1 else torch.cat(crops, dim=0)
+                if self.tile_cache is not None and images_crop_hash is not None:
+                    tile_keys = [
+                        bytes(digest).hex()
+                        for jdx, (width_crop_num, height_crop_num) in enumerate(crop_shapes)
+                        if width_crop_num > 1 or height_crop_num > 1
+                        for digest in images_crop_hash[jdx][0].tolist()
+                    ]
+                    local_features = self._encode_tiles_cached(local_views, tile_keys)
+                else:
+                    local_features = self._encode_views(local_views)
+
+            images_in_this_batch = self._assemble_image_embeddings(global_features, local_features, crop_shapes)
+
+        return images_in_this_batch
+
+    def _cached_pixel_values_to_embedding(
+        self,
+        pixel_values: torch.Tensor,
+        images_crop: torch.Tensor,
+        images_spatial_crop: torch.Tensor,
+        image_keys: List[str],
+        images_crop_hash: Optional[torch.Tensor] = None,
+    ) -> List[torch.Tensor]:
+        # Looks every image up in embedding_cache and only sends the misses through the
+        # encoder; an image repeated within the batch is encoded once.
+        self._sync_cache_namespaces()
+        cached, misses = self.embedding_cache.lookup(image_keys, self.image_newline.device)
+
+        if misses:
+            index = torch.tensor(misses, device=images_spatial_crop.device)
+            if isinstance(pixel_values, torch.Tensor):
+                miss_pixel_values = pixel_values[index.to(pixel_values.device)]
+            else:
+                miss_pixel_values = [pixel_values[jdx] for jdx in misses]
+            embeddings = self._pixel_values_to_embedding(
+                miss_pixel_values, [images_crop[jdx] for jdx in misses], images_spatial_crop[index],
+                images_crop_hash=None if images_crop_hash is None else [images_crop_hash[jdx] for jdx in misses])
+            for jdx, embedding in zip(misses, embeddings):
+                cached[image_keys[jdx]] = embedding
+                self.embedding_cache.put(image_keys[jdx], embedding)
+
+        return [cached[key] for key in image_keys]
+
+    def _encode_tiles_cached(self, local_views: torch.Tensor, tile_keys: List[str]) -> torch.Tensor:
+        # Same for single tiles: only the tiles missing from tile_cache are encoded, the local
+        # features of the others are copied from the cache.
+        self._sync_cache_namespaces()
+        cached, misses = self.tile_cache.lookup(tile_keys, local_views.device)
+
+        if misses:
+            features = self._encode_views(local_views[torch.tensor(misses, device=local_views.device)])
+            for jdx, feature in zip(misses, features):
+                cached[tile_keys[jdx]] = feature
+                self.tile_cache.put(tile_keys[jdx], feature)
+
+        return torch.stack([cached[key] for key in tile_keys], dim=0)
+
+
+class DeepEncoder(DeepEncoderMixin, nn.Module):
+    """
+    The vision tower of DeepSeek-OCR (sam_model, vision_model, projector) on its own, for
+    encoding pages without a vLLM engine. Parameter names match DeepseekOCRForCausalLM, so
+    the same checkpoint tensors load into both.
+    """
+
+    def __init__(
+        self,
+        n_embed: int = 1280,
+        fused_projector: bool = False,
+        sam_attn_chunk_size: int = 0,
+        sam_attn_backend: Optional[str] = None,
+        clip_attn_backend: Optional[str] = None,
+    ):
+        super().__init__()
+        self.sam_model = build_sam_vit_b(attn_chunk_size=sam_attn_chunk_size, attn_backend=sam_attn_backend)
+        self.vision_model = build_clip_l(attn_backend=clip_attn_backend)
+        self.projector = MlpProjector(Dict(projector_type="linear", input_dim=2048, n_embed=n_embed,
+                                           split_input=fused_projector))
+
+        embed_std = 1 / torch.sqrt(torch.tensor(n_embed, dtype=torch.float32))
+        self.image_newline = nn.Parameter(torch.randn(n_embed) * embed_std)
+        self.view_seperator = nn.Parameter(torch.randn(n_embed) * embed_std)
+
+    def load_checkpoint(self, model_path: str) -> None:
+        """Load the vision-tower tensors of a DeepSeek-OCR checkpoint (local directory or hub id)."""
+        loaded = self._load_encoder_weights(iter_encoder_weights(model_path))
+        missing = set(name for name, _ in self.named_parameters()) - loaded
+        if missing:
+            raise RuntimeError(f"{model_path} has no weights for {sorted(missing)}")
+
+
+if __name__ == '__main__':
+    # Scaled-down random-weight benchmark: one encoder call per image (the old loop)
+    # versus one call for all global views plus one for all local tiles.
+    import time
+    from functools import partial
+
+    from deepencoder.clip_sdpa import VitModel, vit_model_cfg
+    from deepencoder.cpu import peak_cpu_bytes
+    from deepencoder.sam_vary_sdpa import ImageEncoderViT
+
+    class _TinyEncoder(DeepEncoderMixin, nn.Module):
+        # two SAM and two CLIP blocks, SAM at `sam_dim` width (768 / 12 heads is ViT-B)
+        def __init__(self, n_embed=256, sam_dim=96, sam_heads=3):
+            super().__init__()
+            self.sam_model = ImageEncoderViT(
+                depth=2, embed_dim=sam_dim, num_heads=sam_heads, img_size=256, mlp_ratio=4,
+                norm_layer=partial(torch.nn.LayerNorm, eps=1e-6), patch_size=16, qkv_bias=True,
+                use_rel_pos=True, global_attn_indexes=[1], window_size=14, out_chans=256,
+            )
+            self.vision_model = VitModel(cfg=Dict(vit_model_cfg, num_layers=2))
+            self.projector = MlpProjector(Dict(projector_type="linear", input_dim=2048, n_embed=n_embed))
+            self.image_newline = nn.Parameter(torch.randn(n_embed))
+            self.view_seperator = nn.Parameter(torch.randn(n_embed))
+
+    torch.manual_seed(0)
+    encoder = _TinyEncoder().eval()
+    base_size, image_size, crop_shape = 256, 160, [3, 2]
+    num_crops = crop_shape[0] * crop_shape[1]
+
+    for num_images in (8, 16, 32, 64):
+        pixel_values = torch.randn(num_images, 1, 3, base_size, base_size)
+        images_crop = torch.randn(num_images, 1, num_crops, 3, image_size, image_size)
+        images_spatial_crop = torch.tensor([[crop_shape]] * num_images)
+
+        start = time.perf_counter()
+        looped = []
+        for jdx in range(num_images):
+            looped += encoder._pixel_values_to_embedding(
+                pixel_values[jdx:jdx + 1], images_crop[jdx:jdx + 1], images_spatial_crop[jdx:jdx + 1])
+        loop_time = time.perf_counter() - start
+
+        start = time.perf_counter()
+        batched = encoder._pixel_values_to_embedding(pixel_values, images_crop, images_spatial_crop)
+        batch_time = time.perf_counter() - start
+
+        identical = all(torch.equal(a, b) for a, b in zip(looped, batched))
+        print(f'images: {num_images:3d}  loop: {loop_time:.3f}s  batched: {batch_time:.3f}s  '
+              f'speedup: {loop_time / batch_time:.2f}x  identical: {identical}')
+
+    # Memory-budget check (CPU) on full-width SAM ViT-B and CLIP-L blocks: tiles streamed in
+    # micro-batches of encoder_memory_budget must stay under the budget, allocate less than one
+    # unbatched call and give its output.
+    torch.manual_seed(0)
+    encoder = _TinyEncoder(sam_dim=768, sam_heads=12).eval()
+    tiles = torch.randn(12, 3, image_size, image_size)
+    per_view = encoder._estimate_view_bytes(tiles)
+    with torch.no_grad():
+        encoder.encoder_memory_budget = 0
+        unbatched, unbatched_peak = peak_cpu_bytes(lambda: encoder._encode_views(tiles))
+        encoder.encoder_memory_budget = 2 * per_view
+        micro_batch = encoder._encoder_micro_batch_size(tiles)
+        streamed, streamed_peak = peak_cpu_bytes(lambda: encoder._encode_views(tiles))
+        encoder.encoder_memory_budget = 0
+
+    within_budget = streamed_peak <= 2 * per_view and streamed_peak < unbatched_peak
+    matches = torch.allclose(streamed, unbatched, rtol=1e-5, atol=1e-5)
+    print(f'estimate {per_view / 1024 ** 2:.1f} MB/view, measured {unbatched_peak / len(tiles) / 1024 ** 2:.1f} MB/view unbatched')
+    print(f'memory budget {2 * per_view / 1024 ** 2:.1f} MB ({micro_batch} views/call): '
+          f'peak {streamed_peak / 1024 ** 2:.1f} MB streamed vs {unbatched_peak / 1024 ** 2:.1f} MB unbatched  '
+          f'within budget: {within_budget}  identical: {torch.equal(streamed, unbatched)}  '
+          f'allclose: {matches} (max abs diff {(streamed - unbatched).abs().max().item():.2e})')
+    if not (within_budget and matches):
+        raise SystemExit(1)
@@ -1,6 +1,9 @@
 
 """Inference-only Deepseek-OCR model compatible with HuggingFace weights."""
+import functools
 import math
+import resource
+import time
 from collections.abc import Iterable, Mapping, Sequence
 from typing import List, Literal, Optional, Set, Tuple, TypedDict, Union
 
@@ -28,7 +31,8 @@ from vllm.transformers_utils.configs.deepseek_vl2 import (DeepseekVLV2Config,
                                                           MlpProjectorConfig,
                                                           VisionEncoderConfig)
 from process.image_process import (
-    DeepseekOCRProcessor, count_tiles)
+    DeepseekOCRProcessor, count_tiles, get_processor)
+from process.tiling import get_target_ratios
 from vllm.transformers_utils.tokenizer import cached_tokenizer_from_config
 # from vllm.utils import is_list_of
 
@@ -40,13 +44,41 @@ from vllm.model_executor.models.utils import (AutoWeightsLoader, WeightsMapper,
 from deepencoder.sam_vary_sdpa import build_sam_vit_b
 from deepencoder.clip_sdpa import build_clip_l
 from deepencoder.build_linear import MlpProjector
+from deepencoder.vision_tower import DeepEncoderMixin, get_image_token_layout, is_encoder_weight
 from addict import Dict
+import os
 # import time
-from config import IMAGE_SIZE, BASE_SIZE, CROP_MODE, PRINT_NUM_VIS_TOKENS, PROMPT
+from config import IMAGE_SIZE, BASE_SIZE, CROP_MODE, MIN_CROPS, MAX_CROPS, PRINT_NUM_VIS_TOKENS, PROMPT, FUSED_PROJECTOR, SAM_ATTN_CHUNK_SIZE, SAM_ATTN_BACKEND, CLIP_ATTN_BACKEND, COMPILE_ENCODER, COMPILE_BUCKETS, ENCODER_MEMORY_BUDGET_GB, EMBEDDING_CACHE_GB, EMBEDDING_CACHE_DIR, TILE_CACHE_GB
 # The image token id may be various
 _IMAGE_TOKEN = "<image>"
 
 
+class DeepseekOCRImageEmbeddingInputs(TypedDict):
+    type: Literal["image_embeds"]
+    data: Union[torch.Tensor, List[torch.Tensor]]
+    """Precomputed projected embeddings, one `(num_image_tokens, n_embed)` per image,
+    laid out like the encoder output (see run_dpsk_ocr_encode.py)."""
+
+
+@functools.lru_cache(maxsize=None)
+def get_image_token_table() -> dict:
+    """
+    Number of image tokens per crop ratio [num_width_tiles, num_height_tiles] for the active
+    preset: (1, 1) (global view only) plus every tile grid crop mode can pick.
+    """
+    patch_size, downsample_ratio = 16, 4
+    global_grid = math.ceil((BASE_SIZE // patch_size) / downsample_ratio)
+    local_grid = math.ceil((IMAGE_SIZE // patch_size) / downsample_ratio)
+
+    crop_ratios = [(1, 1)] + list(get_target_ratios(MIN_CROPS, MAX_CROPS) if CROP_MODE else [])
+    table = {}
+    for crop_ratio in crop_ratios:
+        local_views_tokens, global_views_tokens = get_image_token_layout(
+            crop_ratio, global_grid=global_grid, local_grid=local_grid)
+        table[crop_ratio] = global_views_tokens + local_views_tokens + 1
+    return table
+
+
 class DeepseekOCRProcessingInfo(BaseProcessingInfo):
 
     def get_hf_config(self):
@@ -63,47 +95,12 @@ class DeepseekOCRProcessingInfo(BaseProcessingInfo):
                              image_width: int,
                              image_height: int,
                              cropping: bool = True) -> int:
-        hf_processor = self.get_hf_processor()
-
-
-        # image_size = hf_processor.image_size
-        # patch_size = hf_processor.patch_size
-        # downsample_ratio = hf_processor.downsample_ratio
-
-        image_size = IMAGE_SIZE
-        base_size = BASE_SIZE
-        patch_size = 16
-        downsample_ratio = 4
-
-        if CROP_MODE:
-            if image_width <= 640 and image_height <= 640:
-                crop_ratio = [1, 1]
-            else:
-                # images_crop_raw, crop_ratio = hf_processor.dynamic_preprocess(image)
-
-                # find the closest aspect ratio to the target
-                crop_ratio = count_tiles(image_width, image_height, image_size=IMAGE_SIZE)
-
-                # print('===========')
-                # print('crop_ratio ', crop_ratio)
-                # print('============')
-                
-            num_width_tiles, num_height_tiles = crop_ratio
-        else:
-            num_width_tiles = num_height_tiles = 1
-
-        h = w = math.ceil((base_size // patch_size) / downsample_ratio)
-
-        h2 = w2 = math.ceil((image_size // patch_size) / downsample_ratio)
-
-        global_views_tokens = h * (w + 1)
-        if num_width_tiles >1 or num_height_tiles>1:
-            local_views_tokens = (num_height_tiles * h2) * (num_width_tiles * w2 + 1)
+        # no processor is built here, this runs for every prompt update
+        if CROP_MODE and (image_width > 640 or image_height > 640):
+            crop_ratio = tuple(count_tiles(image_width, image_height, image_size=IMAGE_SIZE))
         else:
-            local_views_tokens = 0
-
-
-        return global_views_tokens + local_views_tokens + 1
+            crop_ratio = (1, 1)
+        return get_image_token_table()[crop_ratio]
 
     def get_image_size_with_most_features(self) -> ImageSize:
 
@@ -112,6 +109,10 @@ class DeepseekOCRProcessingInfo(BaseProcessingInfo):
         return ImageSize(width=640*2, height=640*2)
 
 
+# (width, height, num_images) -> tokenize_with_images output of the blank dummy images
+_DUMMY_FEATURES = {}
+
+
 class DeepseekOCRDummyInputsBuilder(
         BaseDummyInputsBuilder[DeepseekOCRProcessingInfo]):
 
@@ -134,16 +135,23 @@ class DeepseekOCRDummyInputsBuilder(
 
         if '<image>' in PROMPT:
             return {
-                "image":
-                DeepseekOCRProcessor().tokenize_with_images(images = self._get_dummy_images(width=max_image_size.width,
-                                    height=max_image_size.height,
-                                    num_images=num_images), bos=True, eos=True, cropping=CROP_MODE)
+                "image": self._get_dummy_features(max_image_size.width, max_image_size.height, num_images)
             }
         else:
             return {
                 "image": []
             }
 
+    def _get_dummy_features(self, width: int, height: int, num_images: int) -> list:
+        # profiling asks for the same dummy batch several times (encoder and decoder budgets,
+        # every engine start in the process), tokenize it once
+        key = (width, height, num_images)
+        if key not in _DUMMY_FEATURES:
+            _DUMMY_FEATURES[key] = get_processor().tokenize_with_images(
+                images=self._get_dummy_images(width=width, height=height, num_images=num_images),
+                bos=True, eos=True, cropping=CROP_MODE)
+        return _DUMMY_FEATURES[key]
+
 
 
 
@@ -183,8 +191,10 @@ class DeepseekOCRMultiModalProcessor(
         return dict(
             pixel_values=MultiModalFieldConfig.batched("image"),
             images_spatial_crop=MultiModalFieldConfig.batched("image"),
-            # image_embeds=MultiModalFieldConfig.batched("image2"),
+            image_embeds=MultiModalFieldConfig.batched("image"),
             images_crop=MultiModalFieldConfig.batched("image"),
+            images_hash=MultiModalFieldConfig.batched("image"),
+            images_crop_hash=MultiModalFieldConfig.batched("image"),
         )
 
     def _get_prompt_updates(
@@ -209,8 +219,9 @@ class DeepseekOCRMultiModalProcessor(
             else:
 
                 
-                width = images[0][-1][0][0]
-                height = images[0][-1][0][1]
+                # image_shapes of the tokenize_with_images output
+                width = images[0][6][0][0]
+                height = images[0][6][0][1]
 
                 num_image_tokens = self.info.get_num_image_tokens(
                     image_width=width,
@@ -258,7 +269,7 @@ class DeepseekOCRMultiModalProcessor(
     DeepseekOCRMultiModalProcessor,
     info=DeepseekOCRProcessingInfo,
     dummy_inputs=DeepseekOCRDummyInputsBuilder)
-class DeepseekOCRForCausalLM(nn.Module, SupportsMultiModal, SupportsPP):
+class DeepseekOCRForCausalLM(nn.Module, DeepEncoderMixin, SupportsMultiModal, SupportsPP):
 
     hf_to_vllm_mapper = WeightsMapper(orig_to_new_prefix={
         "language.": "language_model.",
@@ -285,17 +296,26 @@ class DeepseekOCRForCausalLM(nn.Module, SupportsMultiModal, SupportsPP):
         tokenizer = cached_tokenizer_from_config(model_config)
         self.image_token_id = tokenizer.vocab[_IMAGE_TOKEN]
 
-        self.sam_model = build_sam_vit_b()
-        self.vision_model = build_clip_l()
+        self.sam_model = build_sam_vit_b(attn_chunk_size=SAM_ATTN_CHUNK_SIZE, attn_backend=SAM_ATTN_BACKEND)
+        self.vision_model = build_clip_l(attn_backend=CLIP_ATTN_BACKEND)
 
         n_embed = 1280
-        self.projector =  MlpProjector(Dict(projector_type="linear", input_dim=2048, n_embed=n_embed))
+        self.projector =  MlpProjector(Dict(projector_type="linear", input_dim=2048, n_embed=n_embed, split_input=FUSED_PROJECTOR))
         self.tile_tag = config.tile_tag
         self.global_view_pos = config.global_view_pos
-    
-        # self.sam_model = torch.compile(self.sam_model, mode="reduce-overhead")
-        # self.vision_model = torch.compile(self.vision_model, mode="reduce-overhead")
-        # self.projector = torch.compile(self.projector, mode="max-autotune")
+
+        self.encoder_memory_budget = int(ENCODER_MEMORY_BUDGET_GB * 1024 ** 3)
+
+        # varying tile counts recompile a plain torch.compile, so compile per tile bucket instead
+        if COMPILE_ENCODER:
+            self.enable_compiled_encoder(buckets=COMPILE_BUCKETS, view_sizes=(IMAGE_SIZE, BASE_SIZE))
+
+        # the processor only emits images_hash / images_crop_hash when these are on
+        if EMBEDDING_CACHE_GB > 0:
+            self.enable_embedding_cache(int(EMBEDDING_CACHE_GB * 1024 ** 3), spill_dir=EMBEDDING_CACHE_DIR)
+        if TILE_CACHE_GB > 0:
+            self.enable_tile_cache(int(TILE_CACHE_GB * 1024 ** 3),
+                                   spill_dir=EMBEDDING_CACHE_DIR and os.path.join(EMBEDDING_CACHE_DIR, 'tiles'))
 
 
 
@@ -336,9 +356,19 @@ class DeepseekOCRForCausalLM(nn.Module, SupportsMultiModal, SupportsPP):
         pixel_values = kwargs.pop("pixel_values", None)
         images_spatial_crop = kwargs.pop("images_spatial_crop", None)
         images_crop = kwargs.pop("images_crop", None)
+        images_hash = kwargs.pop("images_hash", None)
+        images_crop_hash = kwargs.pop("images_crop_hash", None)
+        image_embeds = kwargs.pop("image_embeds", None)
 
+        if image_embeds is not None:
+            if not isinstance(image_embeds, (torch.Tensor, list)):
+                raise ValueError("Incorrect type of image embeddings. "
+                                 f"Got type: {type(image_embeds)}")
 
-        if pixel_values is None or torch.sum(pixel_values).item() == 0:
+            return DeepseekOCRImageEmbeddingInputs(type="image_embeds", data=image_embeds)
+
+        # no pixel-sum test: an all-black uint8 page (UINT8_PIXELS) sums to 0 but still needs embeddings
+        if pixel_values is None:
             return None
 
         if pixel_values is not None:
@@ -354,125 +384,30 @@ class DeepseekOCRForCausalLM(nn.Module, SupportsMultiModal, SupportsPP):
                 raise ValueError("Incorrect type of image crop. "
                                  f"Got type: {type(images_crop)}")
 
-            return [pixel_values, images_crop, images_spatial_crop]
+            return [pixel_values, images_crop, images_spatial_crop, images_hash, images_crop_hash]
 
 
         raise AssertionError("This line should be unreachable.")
     
 
 
-    def _pixel_values_to_embedding(
-        self,
-        pixel_values: torch.Tensor,
-        images_crop: torch.Tensor,
-        images_spatial_crop: torch.Tensor,
-    ) -> NestedTensors:
-
-        # Pixel_values (global view): [n_image, batch_size, 3, height, width]
-        # images_spatial_crop: [n_image, batch_size, [num_tiles_w, num_tiles_h]]
-        # images_crop (local view): [n_image, batch_size, num_pathes, 3, h, w]
-        # split the pixel and image_crop, all batch_size = 1
-
-        images_in_this_batch = []
-
-
-        # print(type(images_crop))
-
-        # print(pixel_values.shape)
-
-
-        with torch.no_grad():
-            for jdx in range(images_spatial_crop.size(0)):
-                # with torch.set_grad_enabled(False):
-                patches = images_crop[jdx][0].to(torch.bfloat16) # batch_size = 1
-                image_ori = pixel_values[jdx]
-                crop_shape = images_spatial_crop[jdx][0]
-
-                if torch.sum(patches).item() != 0:  # if all values = 0, no crop
-                    # P, C, H, W = patches.shape
-                    # crop_flag = 1
-                    local_features_1 = self.sam_model(patches)
-                    #TODO del patches 
-                    # torch.compiler.cudagraph_mark_step_begin()
-                    local_features_2 = self.vision_model(patches, local_features_1)  
-
-
-                    local_features = torch.cat((local_features_2[:, 1:], local_features_1.flatten(2).permute(0, 2, 1)), dim=-1) 
-                    local_features = self.projector(local_features)
-
-
-                    global_features_1 = self.sam_model(image_ori)
-                    global_features_2 = self.vision_model(image_ori, global_features_1) 
-                    global_features = torch.cat((global_features_2[:, 1:], global_features_1.flatten(2).permute(0, 2, 1)), dim=-1) 
-                    global_features = self.projector(global_features)
-
-                    if PRINT_NUM_VIS_TOKENS:
-                        print('=====================')
-                        print('BASE: ', global_features.shape)
-                        print('PATCHES: ', local_features.shape)
-                        print('=====================')
-
-                    _, hw, n_dim = global_features.shape
-                    h = w = int(hw ** 0.5)
-
-                    _2, hw2, n_dim2 = local_features.shape
-                    h2 = w2 = int(hw2 ** 0.5)
-
-                    width_crop_num, height_crop_num = crop_shape[0], crop_shape[1]
-
-                    global_features = global_features.view(h, w, n_dim)
-
-                    global_features = torch.cat(
-                        [global_features, self.image_newline[None, None, :].expand(h, 1, n_dim)], dim=1
-                    )
-
-                    global_features = global_features.view(-1, n_dim)
-
-
-                    local_features = local_features.view(height_crop_num, width_crop_num, h2, w2, n_dim2).permute(0, 2, 1, 3, 4).reshape(height_crop_num*h2, width_crop_num*w2, n_dim2)
-                    local_features = torch.cat(
-                        [local_features, self.image_newline[None, None, :].expand(height_crop_num * h2, 1, n_dim2)], dim=1
-                    )
-                    local_features = local_features.view(-1, n_dim2)
-
-                    global_local_features = torch.cat([local_features, global_features, self.view_seperator[None, :]], dim=0)
-                
-                else:
-                    global_features_1 = self.sam_model(image_ori)
-                    global_features_2 = self.vision_model(image_ori, global_features_1) 
-                    global_features = torch.cat((global_features_2[:, 1:], global_features_1.flatten(2).permute(0, 2, 1)), dim=-1) 
-                    global_features = self.projector(global_features)
-
-                    if PRINT_NUM_VIS_TOKENS:
-                        print('=====================')
-                        print('BASE: ', global_features.shape)
-                        print('NO PATCHES')
-                        print('=====================')
-
-                    _, hw, n_dim = global_features.shape
-                    h = w = int(hw ** 0.5)
-
-                    global_features = global_features.view(h, w, n_dim)
-
-                    global_features = torch.cat(
-                        [global_features, self.image_newline[None, None, :].expand(h, 1, n_dim)], dim=1
-                    )
-
-                    global_features = global_features.view(-1, n_dim)
-
-                    global_local_features = torch.cat([global_features, self.view_seperator[None, :]], dim=0)
-
-                images_in_this_batch.append(global_local_features)
-
-        return images_in_this_batch
-
     def _process_image_input(
             self, image_input) -> torch.Tensor:
         
 
-        # image_input: [pixel_values, images_crop, images_spatial_crop]
+        if isinstance(image_input, dict) and image_input["type"] == "image_embeds":
+            # encoder-skip path: embeddings come from run_dpsk_ocr_encode.py
+            return [
+                embeds.reshape(-1, embeds.size(-1)).to(self.image_newline.device, self.image_newline.dtype)
+                for embeds in image_input["data"]
+            ]
+
+        # image_input: [pixel_values, images_crop, images_spatial_crop, images_hash, images_crop_hash]
     
-        pixel_values = image_input[0].to(torch.bfloat16)
+        pixel_values = image_input[0]
+        if pixel_values.is_floating_point():
+            # uint8 pixels (UINT8_PIXELS) are normalized by the encoder instead
+            pixel_values = pixel_values.to(torch.bfloat16)
         # print(image_input[1][0].shape)
         # print(type(image_input[1]))
         # exit()
@@ -482,9 +417,27 @@ class DeepseekOCRForCausalLM(nn.Module, SupportsMultiModal, SupportsPP):
         # images_crop = image_input[1]
         images_spatial_crop = image_input[2].to(dtype=torch.long)
 
+        images_hash = image_input[3]
+        images_crop_hash = image_input[4]
+
         # local_start = time.time()
-        vision_features = self._pixel_values_to_embedding(
-            pixel_values=pixel_values, images_crop = images_crop,  images_spatial_crop=images_spatial_crop)
+        if self.embedding_cache is not None and images_hash is not None:
+            image_keys = [bytes(digest).hex() for digest in images_hash[:, 0].tolist()]
+            vision_features = self._cached_pixel_values_to_embedding(
+                pixel_values, images_crop, images_spatial_crop, image_keys, images_crop_hash=images_crop_hash)
+        else:
+            vision_features = self._pixel_values_to_embedding(
+                pixel_values=pixel_values, images_crop = images_crop,  images_spatial_crop=images_spatial_crop,
+                images_crop_hash=images_crop_hash)
+
+        if PRINT_NUM_VIS_TOKENS:
+            print('=====================')
+            for crop_shape, features in zip(images_spatial_crop[:, 0].tolist(), vision_features):
+                print('CROP: ', crop_shape, 'VIS TOKENS: ', features.shape[0])
+            compiled_encoder = getattr(self, "_compiled_encoder", None)
+            if compiled_encoder is not None:
+                print('COMPILED ENCODER: ', compiled_encoder.stats())
+            print('=====================')
 
         # local_total_time = time.time() - local_start
 
@@ -562,18 +515,34 @@ class DeepseekOCRForCausalLM(nn.Module, SupportsMultiModal, SupportsPP):
 
 
     def load_weights(self, weights: Iterable[Tuple[str, torch.Tensor]]) -> Set[str]:
-        processed_weights = []
-        
-        for name, tensor in weights:
-            if 'sam_model' in name or 'vision_model' in name or 'projector' in name or 'image_newline' in name or 'view_seperator' in name:
-                new_name = name.replace('model.', '', 1)
-            else:
-                new_name = 'language.' + name
+        start = time.perf_counter()
+        peak_rss_before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+        # Renaming is a generator so only the tensor being loaded is alive at a time (the
+        # checkpoint iterator memory-maps the shards). Vision-tower tensors are copied into
+        # their parameters directly, the rest streams into the language model.
+        encoder_params = self._encoder_params()
+        encoder_loaded = set()
+
+        def language_weights():
+            for name, tensor in weights:
+                if is_encoder_weight(name):
+                    name = name.replace('model.', '', 1)
+                    with torch.no_grad():
+                        encoder_params[name].copy_(tensor)
+                    encoder_loaded.add(name)
+                else:
+                    yield 'language.' + name, tensor
 
-            processed_weights.append((new_name, tensor))
-        
         loader = AutoWeightsLoader(self)
-        autoloaded_weights = loader.load_weights(processed_weights, mapper=self.hf_to_vllm_mapper)
+        autoloaded_weights = loader.load_weights(language_weights(), mapper=self.hf_to_vllm_mapper)
+        autoloaded_weights |= encoder_loaded
+        self._clear_encoder_caches()
+
+        # ru_maxrss is in KB on Linux
+        peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        print(f'deepseek-ocr: loaded {len(autoloaded_weights)} weights in {time.perf_counter() - start:.1f}s, '
+              f'peak RSS {peak_rss / 1024:.0f} MB (+{(peak_rss - peak_rss_before) / 1024:.0f} MB during load)')
 
 
 
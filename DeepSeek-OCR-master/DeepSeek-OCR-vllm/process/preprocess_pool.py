@@ -0,0 +1,70 @@
+from concurrent.futures import Executor, ProcessPoolExecutor, ThreadPoolExecutor
+
+import torch
+import torch.multiprocessing as mp
+from PIL import Image
+
+from config import CROP_MODE, NUM_WORKERS, PREPROCESS_BACKEND
+from process.image_process import get_processor
+
+# Page preprocessing (tokenize_with_images) for the runners, on threads or on processes.
+# PIL resizing, cropping and the tensor conversion hold the GIL for much of their time, so
+# the process backend scales past what threads reach. Importing torch.multiprocessing
+# registers torch's reductions with multiprocessing's pickler: the tensors a worker returns
+# are moved into shared memory and the parent only receives handles (file descriptors),
+# the pixel data is never pickled.
+#
+# Workers come from a forkserver, so they do not inherit the engine's CUDA context and threads
+# as forking the runner would. Like spawned processes they still re-import the runner script
+# as __mp_main__ (its module-level imports included): runners using the process backend must
+# build the engine under `if __name__ == "__main__":`.
+
+
+def tokenize_page(image: Image.Image, cropping: bool = CROP_MODE) -> list:
+    """tokenize_with_images output of a single page, see DeepseekOCRProcessor."""
+    return get_processor().tokenize_with_images(images=[image], bos=True, eos=True, cropping=cropping)
+
+
+def _init_worker():
+    # one intra-op thread per worker process, the pool provides the parallelism
+    torch.set_num_threads(1)
+    get_processor()
+
+
+def get_preprocess_executor(backend: str = PREPROCESS_BACKEND, num_workers: int = NUM_WORKERS) -> Executor:
+    """
+    Executor for tokenize_page, `backend` is "thread" or "process". The process backend only
+    runs picklable top-level functions (tokenize_page) and re-imports the calling script in
+    every worker, see above.
+    """
+    if backend == "thread":
+        return ThreadPoolExecutor(max_workers=num_workers)
+    if backend == "process":
+        ctx = mp.get_context("forkserver")
+        ctx.set_forkserver_preload([__name__])
+        return ProcessPoolExecutor(max_workers=num_workers, mp_context=ctx, initializer=_init_worker)
+    raise ValueError(f"unknown preprocessing backend {backend!r}, expected 'thread' or 'process'")
+
+
+if __name__ == '__main__':
+    # pages/sec of thread vs process preprocessing over 1-64 workers on synthetic A4 pages
+    import os
+    import time
+
+    from process.tiling import synthetic_page
+
+    num_pages = 128
+    pages = [synthetic_page(seed) for seed in range(num_pages)]
+    print(f'{num_pages} pages, {os.cpu_count()} CPUs, crop mode: {CROP_MODE}')
+
+    for num_workers in (1, 2, 4, 8, 16, 32, 64):
+        line = f'{num_workers:3d} workers'
+        for backend in ("thread", "process"):
+            with get_preprocess_executor(backend, num_workers) as executor:
+                # start the workers (and their processor) before timing
+                list(executor.map(tokenize_page, pages[:num_workers]))
+                start = time.perf_counter()
+                list(executor.map(tokenize_page, pages))
+                elapsed = time.perf_counter() - start
+            line += f'  {backend}: {num_pages / elapsed:7.1f} pages/sec'
+        print(line)
@@ -0,0 +1,181 @@
+import hashlib
+from typing import List, Sequence, Tuple
+
+import numpy as np
+import torch
+import torch.nn.functional as F
+from PIL import Image
+
+from config import MIN_CROPS, MAX_CROPS
+from process.tiling import count_tiles
+
+# Tensor-native counterpart of dynamic_preprocess + ImageOps.pad + ImageTransform. A page is
+# converted to a uint8 tensor once and resized with antialiased bicubic interpolation (what
+# PIL's resize does, results are rounded to integers like PIL's 8-bit output). The tiles are
+# a view/permute of the resized page, normalized in one op for the whole stack, and the global
+# view is padded in the same tensor space. Pages of the same size and tile grid are resized as
+# one batch. python -m process.tensor_tiling compares it with the PIL path.
+
+
+def image_to_tensor(image: Image.Image) -> torch.Tensor:
+    # [3, H, W] uint8
+    return torch.from_numpy(np.array(image.convert('RGB'))).permute(2, 0, 1)
+
+
+def resize_pages(pages: torch.Tensor, height: int, width: int) -> torch.Tensor:
+    """[B, 3, H, W] pixels -> [B, 3, height, width] float pixel values in [0, 255]."""
+    if tuple(pages.shape[-2:]) == (height, width):
+        return pages.float()
+    resized = F.interpolate(pages.float(), size=(height, width), mode='bicubic', align_corners=False, antialias=True)
+    return resized.round_().clamp_(0, 255)
+
+
+def pad_pages(pages: torch.Tensor, size: int, fill: Sequence[int]) -> torch.Tensor:
+    """
+    ImageOps.pad(page, (size, size), color=fill) for a [B, 3, H, W] batch: resize to fit
+    (aspect ratio kept, same rounding as ImageOps.contain) and center on a `fill` square.
+    """
+    height, width = pages.shape[-2:]
+    if width > height:
+        new_width, new_height = size, round(height / width * size)
+    elif width < height:
+        new_width, new_height = round(width / height * size), size
+    else:
+        new_width = new_height = size
+    resized = resize_pages(pages, new_height, new_width)
+    if new_width == new_height:
+        return resized
+
+    padded = torch.tensor(fill, dtype=resized.dtype).view(1, 3, 1, 1).repeat(pages.size(0), 1, size, size)
+    x, y = round((size - new_width) * 0.5), round((size - new_height) * 0.5)
+    padded[:, :, y:y + new_height, x:x + new_width] = resized
+    return padded
+
+
+def normalize_pixels(pixels: torch.Tensor, mean: Sequence[float], std: Sequence[float]) -> torch.Tensor:
+    # ToTensor + Normalize on [..., 3, H, W] pixel values in [0, 255]
+    mean = torch.tensor(mean, dtype=pixels.dtype).view(3, 1, 1) * 255
+    std = torch.tensor(std, dtype=pixels.dtype).view(3, 1, 1) * 255
+    return (pixels - mean) / std
+
+
+def get_crop_ratio(width: int, height: int, image_size: int, cropping: bool = True,
+                   min_num: int = MIN_CROPS, max_num: int = MAX_CROPS) -> Tuple[int, int]:
+    # same choice as tokenize_with_images: pages up to 640x640 and non-crop mode are one view
+    if not cropping or (width <= 640 and height <= 640):
+        return (1, 1)
+    return tuple(count_tiles(width, height, min_num, max_num, image_size=image_size))
+
+
+def tile_pages(
+    images: List[Image.Image],
+    base_size: int,
+    image_size: int,
+    cropping: bool = True,
+    mean: Sequence[float] = (0.5, 0.5, 0.5),
+    std: Sequence[float] = (0.5, 0.5, 0.5),
+    min_num: int = MIN_CROPS,
+    max_num: int = MAX_CROPS,
+    normalize: bool = True,
+) -> List[Tuple[torch.Tensor, torch.Tensor, Tuple[int, int]]]:
+    """
+    Global view [3, base_size, base_size], tiles [num_tiles, 3, image_size, image_size]
+    (num_tiles is 0 without a tile grid) and crop ratio (num_width_tiles, num_height_tiles)
+    of each page, normalized like ImageTransform, or uint8 pixels if not `normalize`.
+    """
+    def finish(pixels):
+        return normalize_pixels(pixels, mean, std) if normalize else pixels.to(torch.uint8)
+
+    pages = [image_to_tensor(image) for image in images]
+    crop_ratios = [get_crop_ratio(image.size[0], image.size[1], image_size, cropping, min_num, max_num)
+                   for image in images]
+    fill = [int(x * 255) for x in mean]
+
+    groups = {}
+    for idx, (page, crop_ratio) in enumerate(zip(pages, crop_ratios)):
+        groups.setdefault((tuple(page.shape), crop_ratio), []).append(idx)
+
+    outputs = [None] * len(pages)
+    for (_, crop_ratio), indices in groups.items():
+        batch = torch.stack([pages[idx] for idx in indices])
+        num_width_tiles, num_height_tiles = crop_ratio
+
+        source = batch
+        if image_size <= 640 and not cropping:
+            source = resize_pages(batch, image_size, image_size)
+        global_views = finish(pad_pages(source, base_size, fill))
+
+        if num_width_tiles > 1 or num_height_tiles > 1:
+            resized = resize_pages(batch, num_height_tiles * image_size, num_width_tiles * image_size)
+            # [B, 3, rows * S, cols * S] -> [B, rows * cols, 3, S, S], tiles in row-major order
+            tiles = resized.view(len(indices), 3, num_height_tiles, image_size, num_width_tiles, image_size)
+            tiles = tiles.permute(0, 2, 4, 1, 3, 5).reshape(len(indices), -1, 3, image_size, image_size)
+            tiles = finish(tiles)
+        else:
+            tiles = global_views.new_zeros((len(indices), 0, 3, image_size, image_size))
+
+        for row, idx in enumerate(indices):
+            outputs[idx] = (global_views[row], tiles[row], crop_ratio)
+    return outputs
+
+
+def hash_tile_tensor(tile: torch.Tensor, mean: Sequence[float] = (0.5, 0.5, 0.5),
+                     std: Sequence[float] = (0.5, 0.5, 0.5)) -> bytes:
+    # tile cache key of a tensor tile (normalized or uint8), over its 8-bit pixels like hash_tile
+    if tile.dtype == torch.uint8:
+        pixels = tile
+    else:
+        pixels = ((tile * torch.tensor(std).view(3, 1, 1) + torch.tensor(mean).view(3, 1, 1)) * 255).round_().to(torch.uint8)
+    hasher = hashlib.blake2b(repr(tuple(tile.shape)).encode(), digest_size=16)
+    hasher.update(pixels.contiguous().numpy().tobytes())
+    return hasher.digest()
+
+
+if __name__ == '__main__':
+    # agreement with the PIL path and single-core pages/sec on synthetic Gundam-mode pages
+    import time
+
+    from PIL import ImageOps
+
+    from process.image_process import ImageTransform
+    from process.tiling import dynamic_preprocess, synthetic_page
+
+    torch.set_num_threads(1)
+    base_size, image_size = 1024, 640
+
+    pages = [synthetic_page(seed) for seed in range(16)]
+    transform = ImageTransform()
+    fill = tuple(int(x * 255) for x in transform.mean)
+
+    def pil_path(image):
+        tiles, crop_ratio = dynamic_preprocess(image, image_size=image_size)
+        global_view = transform(ImageOps.pad(image, (base_size, base_size), color=fill))
+        return global_view, torch.stack([transform(tile) for tile in tiles]), tuple(crop_ratio)
+
+    start = time.perf_counter()
+    reference = [pil_path(page) for page in pages]
+    pil_rate = len(pages) / (time.perf_counter() - start)
+
+    start = time.perf_counter()
+    outputs = [tile_pages([page], base_size, image_size)[0] for page in pages]
+    tensor_rate = len(pages) / (time.perf_counter() - start)
+
+    start = time.perf_counter()
+    batched = tile_pages(pages, base_size, image_size)
+    batched_rate = len(pages) / (time.perf_counter() - start)
+
+    max_diff = 0.0
+    for (ref_global, ref_tiles, ref_ratio), (global_view, tiles, crop_ratio) in zip(reference, outputs):
+        assert ref_ratio == crop_ratio and ref_tiles.shape == tiles.shape
+        max_diff = max(max_diff, (ref_global - global_view).abs().max().item(), (ref_tiles - tiles).abs().max().item())
+    batch_diff = max((a[1] - b[1]).abs().max().item() for a, b in zip(outputs, batched))
+
+    # normalized values span 2.0 over 255 levels: 0.0078 is one 8-bit step; PIL and torch both
+    # resample with the a=-0.5 antialiased bicubic kernel and only round differently
+    max_levels = 4
+    matches_pil = max_diff * 127.5 <= max_levels
+    print(f'pages/sec on 1 core  PIL: {pil_rate:.2f}  tensor: {tensor_rate:.2f}  tensor batched: {batched_rate:.2f}')
+    print(f'max abs diff vs PIL: {max_diff:.4f} ({max_diff * 127.5:.1f} 8-bit levels, at most {max_levels})  '
+          f'batched vs single: {batch_diff:.2e}')
+    if not (matches_pil and batch_diff == 0):
+        raise SystemExit(1)
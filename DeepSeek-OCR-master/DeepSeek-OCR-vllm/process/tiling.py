@@ -0,0 +1,152 @@
+import functools
+import hashlib
+import random
+from typing import Tuple
+
+from PIL import Image
+
+from config import MIN_CROPS, MAX_CROPS
+
+# Tile-grid selection and cropping. Only PIL and the config constants are imported here, so
+# preprocessing workers and utilities can use it without loading torch, transformers or the
+# tokenizer (python -m process.tiling checks the import time).
+
+
+@functools.lru_cache(maxsize=None)
+def get_target_ratios(min_num: int = MIN_CROPS, max_num: int = MAX_CROPS) -> Tuple[Tuple[int, int], ...]:
+    # tile grids (width, height) with min_num <= tiles <= max_num, fewest tiles first
+    target_ratios = set(
+        (i, j) for n in range(min_num, max_num + 1) for i in range(1, n + 1) for j in range(1, n + 1) if
+        i * j <= max_num and i * j >= min_num)
+    return tuple(sorted(target_ratios, key=lambda x: x[0] * x[1]))
+
+
+def find_closest_aspect_ratio(aspect_ratio, target_ratios, width, height, image_size):
+    best_ratio_diff = float('inf')
+    best_ratio = (1, 1)
+    area = width * height
+    for ratio in target_ratios:
+        target_aspect_ratio = ratio[0] / ratio[1]
+        ratio_diff = abs(aspect_ratio - target_aspect_ratio)
+        if ratio_diff < best_ratio_diff:
+            best_ratio_diff = ratio_diff
+            best_ratio = ratio
+        elif ratio_diff == best_ratio_diff:
+            if area > 0.5 * image_size * image_size * ratio[0] * ratio[1]:
+                best_ratio = ratio
+    # print(f'width: {width}, height: {height}, best_ratio: {best_ratio}')
+    return best_ratio
+
+
+def count_tiles(orig_width, orig_height, min_num=MIN_CROPS, max_num=MAX_CROPS, image_size=640, use_thumbnail=False):
+    aspect_ratio = orig_width / orig_height
+
+    # calculate the existing image aspect ratio
+    target_ratios = get_target_ratios(min_num, max_num)
+
+    # find the closest aspect ratio to the target
+    target_aspect_ratio = find_closest_aspect_ratio(
+        aspect_ratio, target_ratios, orig_width, orig_height, image_size)
+
+    return target_aspect_ratio
+
+
+def dynamic_preprocess(image, min_num=MIN_CROPS, max_num=MAX_CROPS, image_size=640, use_thumbnail=False):
+    orig_width, orig_height = image.size
+    aspect_ratio = orig_width / orig_height
+
+    # calculate the existing image aspect ratio
+    target_ratios = get_target_ratios(min_num, max_num)
+
+    # find the closest aspect ratio to the target
+    target_aspect_ratio = find_closest_aspect_ratio(
+        aspect_ratio, target_ratios, orig_width, orig_height, image_size)
+
+    # print(target_aspect_ratio)
+    # calculate the target width and height
+    target_width = image_size * target_aspect_ratio[0]
+    target_height = image_size * target_aspect_ratio[1]
+    blocks = target_aspect_ratio[0] * target_aspect_ratio[1]
+
+    # resize the image
+    resized_img = image.resize((target_width, target_height))
+    processed_images = []
+    for i in range(blocks):
+        box = (
+            (i % (target_width // image_size)) * image_size,
+            (i // (target_width // image_size)) * image_size,
+            ((i % (target_width // image_size)) + 1) * image_size,
+            ((i // (target_width // image_size)) + 1) * image_size
+        )
+        # split the image
+        split_img = resized_img.crop(box)
+        processed_images.append(split_img)
+    assert len(processed_images) == blocks
+    if use_thumbnail and len(processed_images) != 1:
+        thumbnail_img = image.resize((image_size, image_size))
+        processed_images.append(thumbnail_img)
+    return processed_images, target_aspect_ratio
+
+
+def hash_tile(tile: Image.Image) -> bytes:
+    # tiles are hashed before normalization: 1 byte per channel instead of 4
+    hasher = hashlib.blake2b(repr((tile.mode, tile.size)).encode(), digest_size=16)
+    hasher.update(tile.tobytes())
+    return hasher.digest()
+
+
+def synthetic_page(seed: int, width: int = 1240, height: int = 1754, figure: bool = False) -> Image.Image:
+    """
+    Reproducible page for the benchmarks: rows of gray word boxes on white paper (A4 at
+    150 dpi by default), plus a colored figure box if `figure`.
+    """
+    from PIL import ImageDraw
+
+    rng = random.Random(seed)
+    margin = min(width, height) // 16
+    page = Image.new("RGB", (width, height), (255, 255, 255))
+    draw = ImageDraw.Draw(page)
+    for y in range(margin, height - margin, 28):
+        x = margin
+        while x < width - margin - 40:
+            word = rng.randint(20, 110)
+            draw.rectangle((x, y, x + word, y + 12), fill=(rng.randint(0, 80),) * 3)
+            x += word + rng.randint(8, 18)
+    if figure:
+        x0, y0 = rng.randint(margin, width // 2), rng.randint(margin, height // 2)
+        draw.rectangle((x0, y0, x0 + width // 3, y0 + height // 4), outline=(0, 0, 0), width=2,
+                       fill=(rng.randint(150, 255), rng.randint(150, 255), rng.randint(150, 255)))
+    return page
+
+
+if __name__ == '__main__':
+    # import-time budget: a fresh interpreter importing config and the tiling utilities must
+    # not pull in the heavy stacks or the tokenizer. process.image_process (what the runners
+    # and deepseek_ocr import) subclasses transformers' ProcessorMixin and builds torch
+    # tensors, so it loads torch / torchvision / transformers by design; its import time is
+    # reported, and it must not load the tokenizer either.
+    import subprocess
+    import sys
+
+    budget = 1.0
+    failed = False
+    for modules, budgeted in (("config, process.tiling", True), ("config, process.image_process", False)):
+        code = (
+            "import sys, time; start = time.perf_counter(); "
+            f"import {modules}; "
+            "print(time.perf_counter() - start); "
+            "print(config.get_tokenizer.cache_info().currsize); "
+            "print(','.join(m for m in ('torch', 'transformers', 'vllm') if m in sys.modules))"
+        )
+        elapsed, tokenizers, heavy = subprocess.run([sys.executable, "-c", code], capture_output=True, text=True,
+                                                    check=True).stdout.split('\n')[:3]
+        if budgeted:
+            print(f'import {modules}: {float(elapsed):.3f}s (budget {budget:.1f}s), '
+                  f'heavy modules loaded: {heavy or "none"}, tokenizer loaded: {tokenizers != "0"}')
+            failed = failed or float(elapsed) > budget or bool(heavy) or tokenizers != "0"
+        else:
+            print(f'import {modules}: {float(elapsed):.3f}s (not budgeted, loads {heavy or "none"}), '
+                  f'tokenizer loaded: {tokenizers != "0"}')
+            failed = failed or tokenizers != "0"
+    if failed:
+        raise SystemExit(1)
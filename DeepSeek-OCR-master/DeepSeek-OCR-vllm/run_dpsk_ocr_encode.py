@@ -0,0 +1,112 @@
+import os
+import io
+import time
+import glob
+import fitz
+from tqdm import tqdm
+import torch
+
+if torch.version.cuda == '11.8':
+    os.environ["TRITON_PTXAS_PATH"] = "/usr/local/cuda-11.8/bin/ptxas"
+
+
+from config import (MODEL_PATH, INPUT_PATH, OUTPUT_PATH, CROP_MODE, NUM_WORKERS, ENCODE_BATCH_SIZE,
+                    FUSED_PROJECTOR, SAM_ATTN_CHUNK_SIZE, SAM_ATTN_BACKEND, CLIP_ATTN_BACKEND,
+                    ENCODER_MEMORY_BUDGET_GB, ENCODER_INT8)
+
+from PIL import Image, ImageOps
+from deepencoder.vision_tower import DeepEncoder, collate_image_features
+from deepencoder.embedding_store import EmbeddingStoreWriter
+from process.preprocess_pool import get_preprocess_executor, tokenize_page
+
+
+# Encode-only runner: SAM + CLIP + projector without the language model. Writes one embedding
+# store per input (see deepencoder/embedding_store.py); set IMAGE_EMBEDS_PATH to it and
+# run_dpsk_ocr_pdf.py only runs prefill and decode.
+
+
+class Colors:
+    RED = '\033[31m'
+    GREEN = '\033[32m'
+    YELLOW = '\033[33m'
+    BLUE = '\033[34m'
+    RESET = '\033[0m'
+
+
+def pdf_to_images_high_quality(pdf_path, dpi=144):
+    """
+    pdf2images, same rendering as run_dpsk_ocr_pdf.py
+    """
+    images = []
+
+    pdf_document = fitz.open(pdf_path)
+
+    zoom = dpi / 72.0
+    matrix = fitz.Matrix(zoom, zoom)
+
+    for page_num in range(pdf_document.page_count):
+        page = pdf_document[page_num]
+
+        pixmap = page.get_pixmap(matrix=matrix, alpha=False)
+        Image.MAX_IMAGE_PIXELS = None
+
+        img_data = pixmap.tobytes("png")
+        images.append(Image.open(io.BytesIO(img_data)))
+
+    pdf_document.close()
+    return images
+
+
+def load_images(input_path):
+    if input_path.endswith('.pdf'):
+        return pdf_to_images_high_quality(input_path)
+    if os.path.isdir(input_path):
+        paths = sorted(glob.glob(f'{input_path}/*.png') + glob.glob(f'{input_path}/*.jpg') + glob.glob(f'{input_path}/*.jpeg'))
+    else:
+        paths = [input_path]
+    return [ImageOps.exif_transpose(Image.open(path)) for path in paths]
+
+
+if __name__ == "__main__":
+
+    device = 'cuda' if torch.cuda.is_available() else 'cpu'
+
+    print(f'{Colors.RED}Loading vision encoder .....{Colors.RESET}')
+    encoder = DeepEncoder(
+        fused_projector=FUSED_PROJECTOR,
+        sam_attn_chunk_size=SAM_ATTN_CHUNK_SIZE,
+        sam_attn_backend=SAM_ATTN_BACKEND,
+        clip_attn_backend=CLIP_ATTN_BACKEND,
+    )
+    encoder.load_checkpoint(MODEL_PATH)
+    if device == 'cpu' and ENCODER_INT8:
+        encoder.enable_int8_mode()
+    elif device == 'cpu':
+        encoder.enable_cpu_mode()
+    else:
+        encoder = encoder.to(device, torch.bfloat16).eval()
+    encoder.encoder_memory_budget = int(ENCODER_MEMORY_BUDGET_GB * 1024 ** 3)
+
+    images = [image.convert('RGB') for image in load_images(INPUT_PATH)]
+
+    with get_preprocess_executor() as executor:
+        features = [page[0] for page in tqdm(
+            executor.map(tokenize_page, images),
+            total=len(images),
+            desc="Pre-processed images"
+        )]
+
+    store_path = os.path.join(OUTPUT_PATH, os.path.basename(INPUT_PATH.rstrip('/')).rsplit('.', 1)[0] + '.embeds')
+
+    start = time.perf_counter()
+    with EmbeddingStoreWriter(store_path) as writer:
+        for idx in tqdm(range(0, len(features), ENCODE_BATCH_SIZE), desc="Encoded batches"):
+            batch = features[idx:idx + ENCODE_BATCH_SIZE]
+            embeddings = encoder._pixel_values_to_embedding(
+                *collate_image_features(batch, device, dtype=next(encoder.parameters()).dtype))
+            for item, embedding in zip(batch, embeddings):
+                writer.write(embedding, crop_shape=item[4][0].tolist(), image_size=list(item[6][0]))
+    elapsed = time.perf_counter() - start
+
+    print(f'{Colors.GREEN}{len(features)} pages / {writer.num_tokens} vision tokens in {elapsed:.1f}s '
+          f'({len(features) / elapsed:.2f} pages/s) -> {store_path}{Colors.RESET}')
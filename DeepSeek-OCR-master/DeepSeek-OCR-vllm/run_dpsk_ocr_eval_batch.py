@@ -8,7 +8,6 @@ os.environ['VLLM_USE_V1'] = '0'
 os.environ["CUDA_VISIBLE_DEVICES"] = '0'
 
 from config import MODEL_PATH, INPUT_PATH, OUTPUT_PATH, PROMPT, MAX_CONCURRENCY, CROP_MODE, NUM_WORKERS
-from concurrent.futures import ThreadPoolExecutor
 import glob
 from PIL import Image
 from deepseek_ocr import DeepseekOCRForCausalLM
@@ -17,22 +16,25 @@ from vllm.model_executor.models.registry import ModelRegistry
 
 from vllm import LLM, SamplingParams
 from process.ngram_norepeat import NoRepeatNGramLogitsProcessor
-from process.image_process import DeepseekOCRProcessor
+from process.preprocess_pool import get_preprocess_executor, tokenize_page
 ModelRegistry.register_model("DeepseekOCRForCausalLM", DeepseekOCRForCausalLM)
 
 
-llm = LLM(
-    model=MODEL_PATH,
-    hf_overrides={"architectures": ["DeepseekOCRForCausalLM"]},
-    block_size=256,
-    enforce_eager=False,
-    trust_remote_code=True, 
-    max_model_len=8192,
-    swap_space=0,
-    max_num_seqs = MAX_CONCURRENCY,
-    tensor_parallel_size=1,
-    gpu_memory_utilization=0.9,
-)
+# preprocessing workers (PREPROCESS_BACKEND = 'process') re-import this file as __mp_main__,
+# only the main process builds the engine
+if __name__ == "__main__":
+    llm = LLM(
+        model=MODEL_PATH,
+        hf_overrides={"architectures": ["DeepseekOCRForCausalLM"]},
+        block_size=256,
+        enforce_eager=False,
+        trust_remote_code=True, 
+        max_model_len=8192,
+        swap_space=0,
+        max_num_seqs = MAX_CONCURRENCY,
+        tensor_parallel_size=1,
+        gpu_memory_utilization=0.9,
+    )
 
 logits_processors = [NoRepeatNGramLogitsProcessor(ngram_size=40, window_size=90, whitelist_token_ids= {128821, 128822})] #window for fast；whitelist_token_ids: <td>,</td>
 
@@ -78,12 +80,12 @@ def re_match(text):
         mathes_other.append(a_match[0])
     return matches, mathes_other
 
-def process_single_image(image):
-    """single image"""
+def page_input(features):
+    """single image, features: tokenize_page output"""
     prompt_in = prompt
     cache_item = {
         "prompt": prompt_in,
-        "multi_modal_data": {"image": DeepseekOCRProcessor().tokenize_with_images(images = [image], bos=True, eos=True, cropping=CROP_MODE)},
+        "multi_modal_data": {"image": features},
     }
     return cache_item
 
@@ -122,12 +124,12 @@ if __name__ == "__main__":
     #     ]
     #     batch_inputs.extend(cache_list)
 
-    with ThreadPoolExecutor(max_workers=NUM_WORKERS) as executor:  
-        batch_inputs = list(tqdm(
-            executor.map(process_single_image, images),
+    with get_preprocess_executor() as executor:
+        batch_inputs = [page_input(features) for features in tqdm(
+            executor.map(tokenize_page, images),
             total=len(images),
             desc="Pre-processed images"
-        ))
+        )]
 
 
     
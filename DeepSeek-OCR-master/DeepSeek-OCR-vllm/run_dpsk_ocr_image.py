@@ -18,7 +18,7 @@ from PIL import Image, ImageDraw, ImageFont, ImageOps
 import numpy as np
 from tqdm import tqdm
 from process.ngram_norepeat import NoRepeatNGramLogitsProcessor
-from process.image_process import DeepseekOCRProcessor
+from process.image_process import get_processor
 from config import MODEL_PATH, INPUT_PATH, OUTPUT_PATH, PROMPT, CROP_MODE
 
 
@@ -211,7 +211,7 @@ if __name__ == "__main__":
     
     if '<image>' in PROMPT:
 
-        image_features = DeepseekOCRProcessor().tokenize_with_images(images = [image], bos=True, eos=True, cropping=CROP_MODE)
+        image_features = get_processor().tokenize_with_images(images = [image], bos=True, eos=True, cropping=CROP_MODE)
     else:
         image_features = ''
 
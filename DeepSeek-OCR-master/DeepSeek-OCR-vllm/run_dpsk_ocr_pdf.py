@@ -5,7 +5,8 @@ import io
 import re
 from tqdm import tqdm
 import torch
-from concurrent.futures import ThreadPoolExecutor
+from concurrent.futures import FIRST_COMPLETED, wait
+from functools import partial
  
 
 if torch.version.cuda == '11.8':
@@ -14,7 +15,7 @@ os.environ['VLLM_USE_V1'] = '0'
 os.environ["CUDA_VISIBLE_DEVICES"] = '0'
 
 
-from config import MODEL_PATH, INPUT_PATH, OUTPUT_PATH, PROMPT, SKIP_REPEAT, MAX_CONCURRENCY, NUM_WORKERS, CROP_MODE
+from config import MODEL_PATH, INPUT_PATH, OUTPUT_PATH, PROMPT, SKIP_REPEAT, MAX_CONCURRENCY, NUM_WORKERS, CROP_MODE, IMAGE_EMBEDS_PATH, ENCODER_WORKERS, ENCODER_WORKER_DEVICES, ENCODER_WORKER_GPU_SHARE, TILE_CACHE_GB, COMPILE_ENCODER
 
 from PIL import Image, ImageDraw, ImageFont
 import numpy as np
@@ -24,24 +25,32 @@ from vllm.model_executor.models.registry import ModelRegistry
 
 from vllm import LLM, SamplingParams
 from process.ngram_norepeat import NoRepeatNGramLogitsProcessor
-from process.image_process import DeepseekOCRProcessor
+from process.preprocess_pool import get_preprocess_executor, tokenize_page
+from deepencoder.embedding_store import load_embedding_store
+from deepencoder.encoder_workers import EncoderWorkerPool, load_pretrained_encoder
 
 ModelRegistry.register_model("DeepseekOCRForCausalLM", DeepseekOCRForCausalLM)
 
 
-llm = LLM(
-    model=MODEL_PATH,
-    hf_overrides={"architectures": ["DeepseekOCRForCausalLM"]},
-    block_size=256,
-    enforce_eager=False,
-    trust_remote_code=True, 
-    max_model_len=8192,
-    swap_space=0,
-    max_num_seqs=MAX_CONCURRENCY,
-    tensor_parallel_size=1,
-    gpu_memory_utilization=0.9,
-    disable_mm_preprocessor_cache=True
-)
+# spawned encoder workers and preprocessing workers (PREPROCESS_BACKEND = 'process') re-import
+# this file as __mp_main__, only the main process builds the engine
+if __name__ == "__main__":
+    # encoder workers on the engine's GPU need their own share of it
+    engine_gpu_workers = sum(
+        ENCODER_WORKER_DEVICES[rank % len(ENCODER_WORKER_DEVICES)] in ('cuda', 'cuda:0') for rank in range(ENCODER_WORKERS))
+    llm = LLM(
+        model=MODEL_PATH,
+        hf_overrides={"architectures": ["DeepseekOCRForCausalLM"]},
+        block_size=256,
+        enforce_eager=False,
+        trust_remote_code=True, 
+        max_model_len=8192,
+        swap_space=0,
+        max_num_seqs=MAX_CONCURRENCY,
+        tensor_parallel_size=1,
+        gpu_memory_utilization=0.9 - ENCODER_WORKER_GPU_SHARE * engine_gpu_workers,
+        disable_mm_preprocessor_cache=True
+    )
 
 logits_processors = [NoRepeatNGramLogitsProcessor(ngram_size=20, window_size=50, whitelist_token_ids= {128821, 128822})] #window for fast；whitelist_token_ids: <td>,</td>
 
@@ -220,16 +229,87 @@ def process_image_with_refs(image, ref_texts, jdx):
     return result_image
 
 
-def process_single_image(image):
-    """single image"""
+def get_tile_cache():
+    # the V0 engine runs the model in this process; only called with TILE_CACHE_GB > 0, other
+    # executors keep the model elsewhere
+    model = llm.llm_engine.model_executor.driver_worker.model_runner.model
+    return model.tile_cache
+
+
+def print_compile_report():
+    # per-bucket hits of the compiled encoder, only called with COMPILE_ENCODER (V0 engine, see get_tile_cache)
+    compiled_encoder = llm.llm_engine.model_executor.driver_worker.model_runner.model._compiled_encoder
+    stats = compiled_encoder.stats()
+    buckets = '  '.join(f'{size}px x{bucket}: {hits}' for (size, bucket), hits in sorted(stats["bucket_hits"].items()))
+    print(f'{Colors.GREEN}compiled encoder bucket hits: {buckets or "none"}  eager calls: {stats["eager_calls"]}  '
+          f'recompiles: {sum(stats["recompiles"].values())}  '
+          f'compile time: {sum(stats["compile_time"].values()):.1f}s{Colors.RESET}')
+
+
+def print_tile_cache_report(tile_cache, num_pages):
+    stats = tile_cache.stats()
+    reused = stats["hits"] + stats["disk_hits"]
+    lookups = reused + stats["misses"]
+    print(f'{Colors.GREEN}tile cache: {reused}/{lookups} tiles of {num_pages} pages reused '
+          f'({stats["hit_rate"]:.1%} of local-view encoder compute), '
+          f'{stats["entries"]} tiles / {stats["bytes"] / 1024 ** 2:.0f} MB cached, '
+          f'{stats["evictions"]} evicted{Colors.RESET}')
+
+
+def page_input(features):
+    """single image, features: tokenize_page output"""
     prompt_in = prompt
     cache_item = {
         "prompt": prompt_in,
-        "multi_modal_data": {"image": DeepseekOCRProcessor().tokenize_with_images(images = [image], bos=True, eos=True, cropping=CROP_MODE)},
+        "multi_modal_data": {"image": features},
     }
     return cache_item
 
 
+def embeds_input(image_embeds):
+    """precomputed embeddings from run_dpsk_ocr_encode.py, the engine skips the vision encoder"""
+    return {
+        "prompt": prompt,
+        "multi_modal_data": {"image": image_embeds.unsqueeze(0)},
+    }
+
+
+def generate_with_encoder_workers(images):
+    """
+    Encoder disaggregation: pages are encoded in ENCODER_WORKERS separate processes and each
+    page is handed to the engine as image_embeds as soon as it is done, while the engine
+    keeps decoding the pages that arrived earlier.
+    """
+    engine = llm.llm_engine
+    outputs = {}
+
+    with EncoderWorkerPool(partial(load_pretrained_encoder, MODEL_PATH), num_workers=ENCODER_WORKERS,
+                           devices=ENCODER_WORKER_DEVICES) as pool:
+        with get_preprocess_executor() as executor:
+            pending = {
+                idx: pool.submit_features(features)
+                for idx, features in enumerate(executor.map(tokenize_page, images))
+            }
+
+        progress = tqdm(total=len(images), desc="Decoded pages")
+        while pending or engine.has_unfinished_requests():
+            for idx, future in list(pending.items()):
+                if future.done():
+                    engine.add_request(str(idx), embeds_input(future.result()[0]), sampling_params)
+                    del pending[idx]
+
+            if engine.has_unfinished_requests():
+                for output in engine.step():
+                    if output.finished:
+                        outputs[int(output.request_id)] = output
+                        progress.update(1)
+            else:
+                wait(pending.values(), return_when=FIRST_COMPLETED)
+        progress.close()
+
+    return [outputs[idx] for idx in range(len(images))]
+
+
 if __name__ == "__main__":
 
     os.makedirs(OUTPUT_PATH, exist_ok=True)
@@ -245,12 +325,19 @@ if __name__ == "__main__":
 
     # batch_inputs = []
 
-    with ThreadPoolExecutor(max_workers=NUM_WORKERS) as executor:  
-        batch_inputs = list(tqdm(
-            executor.map(process_single_image, images),
-            total=len(images),
-            desc="Pre-processed images"
-        ))
+    if ENCODER_WORKERS > 0:
+        batch_inputs = None
+    elif IMAGE_EMBEDS_PATH:
+        image_embeds = load_embedding_store(IMAGE_EMBEDS_PATH)
+        assert len(image_embeds) == len(images), f'{IMAGE_EMBEDS_PATH} holds {len(image_embeds)} pages, the pdf {len(images)}'
+        batch_inputs = [embeds_input(embeds) for embeds in image_embeds]
+    else:
+        with get_preprocess_executor() as executor:
+            batch_inputs = [page_input(features) for features in tqdm(
+                executor.map(tokenize_page, images),
+                total=len(images),
+                desc="Pre-processed images"
+            )]
 
 
     # for image in tqdm(images):
@@ -259,16 +346,29 @@ if __name__ == "__main__":
     #     cache_list = [
     #         {
     #             "prompt": prompt_in,
-    #             "multi_modal_data": {"image": DeepseekOCRProcessor().tokenize_with_images(images = [image], bos=True, eos=True, cropping=CROP_MODE)},
+    #             "multi_modal_data": {"image": get_processor().tokenize_with_images(images = [image], bos=True, eos=True, cropping=CROP_MODE)},
     #         }
     #     ]
     #     batch_inputs.extend(cache_list)
 
 
-    outputs_list = llm.generate(
-        batch_inputs,
-        sampling_params=sampling_params
-    )
+    # per-document hit rate: drop the lookups of the profiling run and earlier documents
+    tile_cache = get_tile_cache() if TILE_CACHE_GB > 0 else None
+    if tile_cache is not None:
+        tile_cache.reset_stats()
+
+    if ENCODER_WORKERS > 0:
+        outputs_list = generate_with_encoder_workers(images)
+    else:
+        outputs_list = llm.generate(
+            batch_inputs,
+            sampling_params=sampling_params
+        )
+
+    if tile_cache is not None:
+        print_tile_cache_report(tile_cache, len(images))
+    if COMPILE_ENCODER:
+        print_compile_report()
 
 
     output_path = OUTPUT_PATH